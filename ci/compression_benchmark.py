@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+"""Compare compression ratio against wall time for the build compressors.
+
+usage: compression_benchmark.py DIRECTORY [THREADS]
+
+Creates an uncompressed tarball of DIRECTORY and compresses it with every
+compressor that devflow-autopkg can use, printing the resulting ratio and the
+wall time of each run.
+
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import multiprocessing
+
+
+def compressors(threads):
+    return [("gzip -6", ["gzip", "-6", "-c"]),
+            ("pigz -6", ["pigz", "-6", "-p", str(threads), "-c"]),
+            ("bzip2 -9", ["bzip2", "-9", "-c"]),
+            ("xz -6", ["xz", "-6", "-T1", "-c"]),
+            ("xz -6 -T%d" % threads, ["xz", "-6", "-T%d" % threads, "-c"]),
+            ("zstd -19", ["zstd", "-19", "-T1", "-c"]),
+            ("zstd -19 -T%d" % threads,
+             ["zstd", "-19", "-T%d" % threads, "-c"])]
+
+
+def main():
+    try:
+        directory = sys.argv[1]
+    except IndexError:
+        sys.stdout.write(__doc__)
+        return 1
+    if len(sys.argv) > 2:
+        threads = int(sys.argv[2])
+    else:
+        threads = multiprocessing.cpu_count()
+
+    tarball = tempfile.NamedTemporaryFile(suffix=".tar")
+    try:
+        subprocess.check_call(["tar", "-cf", tarball.name, "-C", directory,
+                               "."])
+    except subprocess.CalledProcessError as e:
+        sys.stderr.write("Failed to archive '%s': %s\n" % (directory, e))
+        return 1
+    size = os.path.getsize(tarball.name)
+    print "Uncompressed size: %d bytes" % size
+    print "%-16s %12s %8s %10s" % ("compressor", "bytes", "ratio", "seconds")
+
+    devnull = open(os.devnull, "w")
+    for name, cmd in compressors(threads):
+        output = tempfile.TemporaryFile()
+        start = time.time()
+        try:
+            with open(tarball.name) as f:
+                subprocess.check_call(cmd, stdin=f, stdout=output,
+                                      stderr=devnull)
+        except OSError:
+            print "%-16s %s" % (name, "not installed")
+            continue
+        except subprocess.CalledProcessError as e:
+            print "%-16s %s" % (name, "failed with exit code %d"
+                                % e.returncode)
+            continue
+        elapsed = time.time() - start
+        output.seek(0, os.SEEK_END)
+        compressed = output.tell()
+        print "%-16s %12d %8.3f %10.2f" % (name, compressed,
+                                           float(compressed) / size, elapsed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
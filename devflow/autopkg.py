@@ -35,37 +35,32 @@
 
 import os
 import sys
+import json
+import multiprocessing
 
+from collections import OrderedDict
 from git import GitCommandError
 from optparse import OptionParser
-from sh import mktemp, cd, rm, git_dch  # pylint: disable=E0611
+from sh import mktemp, cd, rm, git_dch, dpkg_deb  # pylint: disable=E0611
 
 from devflow import versioning
 from devflow import utils
 from devflow import BRANCH_TYPES
-
-if sys.stdout.isatty():
-    try:
-        import colors
-        use_colors = True
-    except AttributeError:
-        use_colors = False
-else:
-    use_colors = False
-
-
-if use_colors:
-    red = colors.red
-    green = colors.green
-else:
-    red = lambda x: x
-    green = lambda x: x
-
-print_red = lambda x: sys.stdout.write(red(x) + "\n")
-print_green = lambda x: sys.stdout.write(green(x) + "\n")
+from devflow.refs import invalidate_ref_index
+from devflow.utils import call, red, print_red, print_green
 
 AVAILABLE_MODES = ["release", "snapshot"]
 
+# Compressors that can be selected for the build artifacts. 'pigz' produces
+# gzip-compatible output using multiple threads. 'zstd' is only supported by
+# dpkg-deb, so source tarballs fall back to 'xz' when it is selected. dpkg-deb
+# can not build 'bzip2' members, so binary packages use 'xz' instead.
+AVAILABLE_COMPRESSORS = ["gzip", "pigz", "bzip2", "xz", "zstd"]
+SOURCE_COMPRESSORS = {"gzip": "gzip", "pigz": "gzip", "bzip2": "bzip2",
+                      "xz": "xz", "zstd": "xz"}
+DEB_COMPRESSORS = {"gzip": "gzip", "pigz": "gzip", "bzip2": "xz",
+                   "xz": "xz", "zstd": "zstd"}
+
 DESCRIPTION = """Tool for automatical build of debian packages.
 
 %(prog)s is a helper script for automatic build of debian packages from
@@ -130,6 +125,13 @@ def main():
     parser.add_option("--key-id",
                       dest="keyid",
                       help="Use this keyid for gpg signing")
+    parser.add_option("--defer-signing",
+                      dest="defer_signing",
+                      default=False,
+                      action="store_true",
+                      help="Build unsigned packages and tags, and record them"
+                           " in the build directory so that they can be"
+                           " signed later by devflow-sign")
     parser.add_option("--dist",
                       dest="dist",
                       default=None,
@@ -150,6 +152,35 @@ def main():
                       default=False,
                       action="store_true",
                       help="Automatically push branches and tags to repo.")
+    parser.add_option("--compression",
+                      dest="compression",
+                      default=None,
+                      help="Compressor for the source tarballs and the binary"
+                           " packages. One of: %s"
+                           % ", ".join(AVAILABLE_COMPRESSORS))
+    parser.add_option("--compression-level",
+                      dest="compression_level",
+                      type="int",
+                      default=None,
+                      help="Compression level to use")
+    parser.add_option("--compression-threads",
+                      dest="compression_threads",
+                      type="int",
+                      default=None,
+                      help="Number of threads used by the compressor."
+                           " Use 0 for one thread per CPU")
+    parser.add_option("--plan",
+                      dest="plan",
+                      default=False,
+                      action="store_true",
+                      help="Only print the versions, tags, debian branch and"
+                           " distribution that the build would use, without"
+                           " cloning or changing anything")
+    parser.add_option("--plan-json",
+                      dest="plan_json",
+                      default=False,
+                      action="store_true",
+                      help="Like --plan, but print the plan as JSON")
 
     (options, args) = parser.parse_args()
 
@@ -158,6 +189,10 @@ def main():
         parser.print_help()
         return
 
+    if options.push_back and options.sign and options.defer_signing:
+        # The tags are signed later, by devflow-sign
+        parser.error("--push-back can not be used with --defer-signing")
+
     # Get build mode
     try:
         mode = args[0]
@@ -170,16 +205,6 @@ def main():
     # Load the repository
     original_repo = utils.get_repository()
 
-    # Check that repository is clean
-    toplevel = original_repo.working_dir
-    if original_repo.is_dirty() and not options.force_dirty:
-        raise RuntimeError(red("Repository %s is dirty." % toplevel))
-
-    # Get packages from configuration file
-    config = utils.get_config(options.config_file)
-    packages = config['packages'].keys()
-    print_green("Will build the following packages:\n" + "\n".join(packages))
-
     # Get current branch name and type and check if it is a valid one
     branch = original_repo.head.reference.name
     branch = utils.undebianize(branch)
@@ -190,7 +215,29 @@ def main():
         raise ValueError("Malformed branch name '%s', cannot classify as"
                          " one of %s" % (branch, allowed_branches))
 
-    # Fix needed environment variables
+    if options.plan or options.plan_json:
+        plan = get_build_plan(original_repo, branch, mode, options)
+        if options.plan_json:
+            print json.dumps(plan, indent=2, separators=(",", ": "))
+        else:
+            print "\n".join("%s: %s" % (name, val)
+                            for name, val in plan.items())
+        return
+
+    # Check that repository is clean
+    toplevel = original_repo.working_dir
+    if original_repo.is_dirty() and not options.force_dirty:
+        raise RuntimeError(red("Repository %s is dirty." % toplevel))
+
+    # Get packages from configuration file
+    config = utils.get_config(options.config_file)
+    packages = config['packages'].keys()
+    print_green("Will build the following packages:\n" + "\n".join(packages))
+    compression = get_compression_settings(options, config)
+
+    # Fix needed environment variables. Version information exported by a
+    # parent process describes another tree.
+    versioning.unexport_version_env()
     v = utils.get_vcs_info()
     os.environ["DEVFLOW_BUILD_MODE"] = mode
     os.environ["DEBFULLNAME"] = v.name
@@ -231,13 +278,13 @@ def main():
 
     # Compute python and debian version
     cd(repo_dir)
-    python_version = versioning.get_python_version()
-    debian_version = versioning.\
-        debian_version_from_python_version(python_version)
+    version_env = versioning.version_env(utils.get_vcs_info(), mode)
+    python_version = version_env["DEVFLOW_VERSION"]
+    debian_version = version_env["DEVFLOW_DEBIAN_VERSION"]
     print_green("The new debian version will be: '%s'" % debian_version)
 
     # Update the version files
-    versioning.update_version()
+    versioning.update_version(version_env)
 
     if not options.sign:
         sign_tag_opt = None
@@ -248,16 +295,24 @@ def main():
     else:
         sign_tag_opt = None
 
+    deferred_tags = []
+    defer_tag_signing = options.defer_signing and sign_tag_opt is not None
+    if defer_tag_signing:
+        sign_tag_opt = None
+
     # Tag branch with python version
     branch_tag = python_version
     tag_message = "%s version %s" % (mode.capitalize(), python_version)
     try:
         repo.git.tag(branch_tag, branch, sign_tag_opt, "-m %s" % tag_message)
+        if defer_tag_signing:
+            deferred_tags.append(branch_tag)
     except GitCommandError:
         # Tag may already exist, if only the debian branch has changed
         pass
     upstream_tag = "upstream/" + branch_tag
     repo.git.tag(upstream_tag, branch)
+    invalidate_ref_index(repo)
 
     # Update changelog
     dch = git_dch("--debian-branch=%s" % debian_branch,
@@ -296,6 +351,9 @@ def main():
     tag_message = "%s version %s" % (mode.capitalize(), debian_version)
     if mode == "release":
         repo.git.tag(debian_branch_tag, sign_tag_opt, "-m %s" % tag_message)
+        invalidate_ref_index(repo)
+        if defer_tag_signing:
+            deferred_tags.append(debian_branch_tag)
 
     # Add version.py files to repo
     call("grep \"__version_vcs\" -r . -l -I | xargs git add -f")
@@ -306,28 +364,52 @@ def main():
     for _, pkg_info in config['packages'].items():
         if pkg_info.get("version_file"):
             version_files.extend(pkg_info.as_list('version_file'))
-    # Export version info to debuilg environment
-    os.environ["DEB_DEVFLOW_DEBIAN_VERSION"] = debian_version
-    os.environ["DEB_DEVFLOW_VERSION"] = python_version
+    # Export version info to debuild environment, so that version files
+    # are not computed again from git
+    versioning.export_version_env(version_env)
     build_cmd = "git-buildpackage --git-export-dir=%s"\
                 " --git-upstream-branch=%s --git-debian-branch=%s"\
                 " --git-export=INDEX --git-ignore-new -sa"\
                 " --source-option=--auto-commit"\
                 " --git-upstream-tag=%s"\
                 % (build_dir, branch, debian_branch, upstream_tag)
+    shim_dir = None
+    build_env = None
+    if compression is not None:
+        if compression[0] == "pigz":
+            shim_dir = create_temp_directory("df-pigz")
+        build_opts, build_env = compression_build_options(shim_dir,
+                                                          *compression)
+        build_cmd += " " + " ".join(build_opts)
+        build_env = dict(os.environ, **build_env)
     if options.source_only:
         build_cmd += " -S"
-    if not options.sign:
+    if not options.sign or options.defer_signing:
         build_cmd += " -uc -us"
     elif options.keyid:
         build_cmd += " -k\"'%s'\"" % options.keyid
-    call(build_cmd)
+    try:
+        call(build_cmd, env=build_env)
+    finally:
+        if shim_dir is not None:
+            rm("-r", shim_dir)
 
     # Remove cloned repo
-    if mode != 'release' and not options.keep_repo:
+    remove_repo = mode != 'release' and not options.keep_repo
+    if remove_repo:
         print_green("Removing cloned repo '%s'." % repo_dir)
         rm("-r", repo_dir)
 
+    if options.sign and options.defer_signing:
+        from devflow import signing
+        if remove_repo:
+            # Tags of removed repositories do not need a signature
+            deferred_tags = []
+        signing.record_deferred_signing(build_dir, repo_dir, deferred_tags,
+                                        options.keyid)
+        print_green("Signing has been deferred. Run 'devflow-sign %s' to sign"
+                    " the packages and tags." % build_dir)
+
     # Print final info
     info = (("Version", debian_version),
             ("Upstream branch", branch),
@@ -345,6 +427,9 @@ def main():
         print_green("Created remote 'original_origin' for the repository '%s'"
                     % origin)
 
+        if options.sign and options.defer_signing:
+            print_green("Sign the tags with 'devflow-sign %s' before"
+                        " pushing them." % build_dir)
         print_green("To update repositories '%s' and '%s' go to '%s' and run:"
                     % (toplevel, origin, repo_dir))
         for remote in ['origin', 'original_origin']:
@@ -356,16 +441,151 @@ def main():
             print_green("Automatically updated origin repo.")
 
 
+def get_build_plan(repo, branch, mode, options):
+    """Compute the versions, tags and branches that a build would use.
+
+    The result of merging the branch into its debian branch in the cloned
+    repository is predicted from the refs of the original repository, so
+    nothing is cloned, created or written.
+
+    """
+    if options.debian_branch:
+        debian_branch, start_point = options.debian_branch, None
+    else:
+        debian_branch, start_point = utils.find_debian_branch(branch, repo)
+    upstream_sha = repo.commit(branch).hexsha
+    debian_sha = repo.commit(start_point or debian_branch).hexsha
+
+    if repo.is_ancestor(debian_sha, upstream_sha):
+        merge, head = "fast-forward", upstream_sha
+    elif repo.is_ancestor(upstream_sha, debian_sha):
+        merge, head = "up-to-date", debian_sha
+    else:
+        merge, head = "merge", None
+
+    if head is None:
+        parents = [debian_sha, upstream_sha]
+        revno = utils.get_commit_count(repo, debian_sha, upstream_sha) + 1
+        version_rev = upstream_sha
+    else:
+        parents = [p.hexsha for p in repo.commit(head).parents]
+        revno = utils.get_commit_count(repo, head)
+        version_rev = head
+    revid = utils.format_commit_id(head, parents, debian_branch)
+
+    config = repo.config_reader()
+    vcs_info = utils.vcs_info(branch=debian_branch, revid=revid, revno=revno,
+                              toplevel=repo.working_dir,
+                              name=config.get_value("user", "name", ""),
+                              email=config.get_value("user", "email", ""))
+    base_version = versioning.get_base_version_at(repo, version_rev)
+    python_version = versioning.python_version(base_version, vcs_info, mode)
+    debian_version = versioning.\
+        debian_version_from_python_version(python_version)
+
+    if options.dist is not None:
+        distribution = options.dist
+    elif mode == "release":
+        distribution = utils.get_distribution_codename()
+    else:
+        distribution = "unstable"
+
+    return OrderedDict([
+        ("mode", mode),
+        ("branch", branch),
+        ("debian_branch", debian_branch),
+        ("debian_branch_start_point", start_point),
+        ("merge", merge),
+        ("base_version", base_version),
+        ("revno", revno),
+        ("revid", revid),
+        ("python_version", python_version),
+        ("debian_version", debian_version),
+        ("tag", python_version),
+        ("upstream_tag", "upstream/" + python_version),
+        ("debian_tag", "debian/" + utils.version_to_tag(debian_version)),
+        ("distribution", distribution)])
+
+
+def get_compression_settings(options, config):
+    """Return the (compressor, level, threads) to use for the build.
+
+    Command line options override the values of the 'build' section of the
+    configuration file. Returns None if no compressor has been selected, in
+    which case the defaults of the build tools are used.
+
+    """
+    build_config = config.get("build", {})
+    compressor = options.compression or build_config.get("compression")
+    if compressor is None:
+        return None
+    if compressor not in AVAILABLE_COMPRESSORS:
+        raise ValueError(red("Invalid compressor '%s'. Must be one of: %s"
+                             % (compressor, ", ".join(AVAILABLE_COMPRESSORS))))
+    level = options.compression_level
+    if level is None and build_config.get("compression_level"):
+        level = int(build_config["compression_level"])
+    threads = options.compression_threads
+    if threads is None:
+        threads = int(build_config.get("compression_threads", 1))
+    if threads == 0:
+        threads = multiprocessing.cpu_count()
+    if compressor == "zstd" and not dpkg_supports_zstd():
+        print_red("dpkg-deb does not support zstd. Falling back to xz.")
+        compressor = "xz"
+    return compressor, level, threads
+
+
+def dpkg_supports_zstd():
+    """Check whether the installed dpkg-deb can build zstd packages."""
+    return "zstd" in str(dpkg_deb("--help"))
+
+
+def compression_build_options(shim_dir, compressor, level, threads):
+    """Return git-buildpackage options and environment for compression.
+
+    The compressor is passed to the creation of the orig tarball
+    (git-buildpackage), the debian tarball (dpkg-source) and the data
+    members of the binary packages (dpkg-deb). Since debuild sanitizes the
+    environment, the builder is set explicitly so that the variables that
+    control the threads of the compressors reach the build.
+
+    For 'pigz', a 'gzip' wrapper is created in 'shim_dir' and prepended to
+    the PATH, so that the orig and debian tarballs are compressed by pigz.
+    dpkg-deb compresses with its builtin zlib, so the members of the binary
+    packages are not affected.
+
+    """
+    source_compressor = SOURCE_COMPRESSORS[compressor]
+    opts = ["--git-compression=%s" % source_compressor,
+            "--source-option=--compression=%s" % source_compressor]
+    env = {"DPKG_DEB_COMPRESSOR_TYPE": DEB_COMPRESSORS[compressor],
+           "DPKG_DEB_THREADS_MAX": str(threads),
+           "XZ_OPT": "-T%d" % threads,
+           "ZSTD_NBTHREADS": str(threads)}
+    if level is not None:
+        opts.append("--git-compression-level=%d" % level)
+        opts.append("--source-option=--compression-level=%d" % level)
+        env["DPKG_DEB_COMPRESSOR_LEVEL"] = str(level)
+
+    builder = ["debuild"]
+    builder.extend("--preserve-envvar=%s" % var for var in sorted(env))
+    if compressor == "pigz":
+        gzip_shim = os.path.join(shim_dir, "gzip")
+        with open(gzip_shim, "w") as f:
+            f.write("#!/bin/sh\nexec pigz -p %d \"$@\"\n" % threads)
+        os.chmod(gzip_shim, 0755)
+        env["PATH"] = shim_dir + ":" + os.environ.get("PATH", "")
+        builder.append("--prepend-path=%s" % shim_dir)
+    builder.extend(["-i", "-I"])
+    opts.append("--git-builder='%s'" % " ".join(builder))
+    return opts, env
+
+
 def create_temp_directory(suffix):
     create_dir_cmd = mktemp("-d", "/tmp/" + suffix + "-XXXXX")
     return create_dir_cmd.stdout.strip()
 
 
-def call(cmd):
-    rc = os.system(cmd)
-    if rc:
-        raise RuntimeError("Command '%s' failed!" % cmd)
-
-
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,124 @@
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+
+
+"""Classification of branch names according to the devflow branch types."""
+
+import re
+
+
+class BranchInfo(object):
+    """The result of classifying a branch name.
+
+    name:       the branch name
+    type:       the branch type, e.g. 'feature', or the first component of
+                the name if it is not of a known type
+    normalized: the name of the upstream branch, e.g. 'master' for 'debian'
+    version:    the version in the name of a versioned branch, or None
+    debian:     whether this is a debian branch
+    codename:   the distribution codename of a debian branch, or None
+
+    """
+    __slots__ = ["name", "type", "normalized", "version", "debian",
+                 "codename"]
+
+    def __init__(self, name, type, normalized, version, debian, codename):
+        self.name = name
+        self.type = type
+        self.normalized = normalized
+        self.version = version
+        self.debian = debian
+        self.codename = codename
+
+    def __repr__(self):
+        return "<BranchInfo %s: type=%s normalized=%s version=%s>" %\
+               (self.name, self.type, self.normalized, self.version)
+
+
+class BranchClassifier(object):
+    """Classify branch names for a set of branch types and a codename.
+
+    The patterns of all branch types are compiled once, and the result of
+    every classification is cached, so classifying a name again is a
+    dictionary lookup.
+
+    """
+
+    def __init__(self, branch_types, codename):
+        self.branch_types = branch_types
+        self.codename = codename
+        self.version_res = dict((name, re.compile(btype.allowed_version_re))
+                                for name, btype in branch_types.items())
+        # Debian branches are 'debian', 'debian-<branch>', and, for the
+        # codename, '<codename>', 'debian-<codename>' and
+        # 'debian-<codename>-<branch>'
+        if codename:
+            codename_re = re.escape(codename)
+            pattern = "^(?:debian(?:-(?P<cn>%s)(?:-(?P<cnbranch>.+))?|"\
+                      "-(?P<branch>.+))?|(?P<bare>%s))$" % (codename_re,
+                                                            codename_re)
+        else:
+            pattern = "^debian(?:-(?P<branch>.+))?$"
+        self._debian_re = re.compile(pattern)
+        self._cache = {}
+
+    def classify(self, name):
+        """Return the BranchInfo of a branch name"""
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        m = self._debian_re.match(name)
+        if m is None:
+            debian, codename, normalized = False, None, name
+        else:
+            groups = m.groupdict()
+            debian = True
+            codename = self.codename if groups.get("cn") or \
+                groups.get("bare") else None
+            normalized = groups.get("cnbranch") or groups["branch"] or \
+                "master"
+        parts = normalized.split("-")
+        btype = parts[0]
+        version = None
+        if btype in self.branch_types and \
+           self.branch_types[btype].versioned and len(parts) > 1:
+            version = parts[1]
+        info = BranchInfo(name, btype, normalized, version, debian, codename)
+        self._cache[name] = info
+        return info
+
+    def version_re(self, btype):
+        """Return the compiled pattern of the versions of a branch type"""
+        return self.version_res[btype]
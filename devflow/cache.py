@@ -0,0 +1,179 @@
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+
+"""Shared cache of version information, content-addressed by commit.
+
+The cache is a plain directory, usually on a filesystem that is shared by
+several build nodes, and is enabled by setting DEVFLOW_CACHE_DIR. Every
+entry is a file whose name is the hash of the kind of the entry and of its
+inputs, e.g. a commit sha. Entries are written to a temporary file that is
+renamed in place, so readers always see a complete entry and no locking is
+needed. Every entry also records its key, so that a damaged entry is
+ignored instead of returned.
+
+The number of entries is capped by DEVFLOW_CACHE_SIZE. Entries are touched
+when they are read, and the least recently used are evicted first.
+
+"""
+
+import os
+import json
+import time
+import random
+import hashlib
+import tempfile
+
+
+# Default maximum number of entries
+DEFAULT_SIZE = 10000
+# Fraction of writes that check the size of the cache
+EVICT_PROBABILITY = 0.05
+# Temporary files older than this are left over from killed writers
+STALE_TEMP_AGE = 3600
+_TEMP_PREFIX = ".tmp-"
+
+
+class VersionCache(object):
+    """Cache of version information in a directory"""
+
+    def __init__(self, directory, max_size=DEFAULT_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def _path(self, key):
+        digest = hashlib.sha1("\0".join(key)).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def get(self, kind, *inputs):
+        """Return the cached value of an entry, or None"""
+        key = [kind] + [str(i) for i in inputs]
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(entry, dict) or entry.get("key") != key:
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            # Read-only caches are still useful
+            pass
+        return entry.get("value")
+
+    def put(self, kind, value, *inputs):
+        """Store the value of an entry"""
+        key = [kind] + [str(i) for i in inputs]
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        except OSError:
+            # Created by another writer, or not writable
+            if not os.path.isdir(directory):
+                return
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=_TEMP_PREFIX,
+                                            dir=directory)
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"key": key, "value": value}, f)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+        if random.random() < EVICT_PROBABILITY:
+            self.evict()
+
+    def _entries(self):
+        now = time.time()
+        for subdir in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                path = os.path.join(subdir, name)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    # Evicted by another node
+                    continue
+                if name.startswith(_TEMP_PREFIX):
+                    if now - mtime > STALE_TEMP_AGE:
+                        _remove(path)
+                    continue
+                yield mtime, path
+
+    def evict(self):
+        """Remove the least recently used entries above the size cap.
+
+        Several nodes may evict at the same time. Removing an entry is
+        always safe, as it only causes a recomputation.
+
+        """
+        try:
+            entries = sorted(self._entries())
+        except OSError:
+            return
+        for _, path in entries[:max(0, len(entries) - self.max_size)]:
+            _remove(path)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+_caches = {}
+
+
+def get_version_cache():
+    """Return the cache of DEVFLOW_CACHE_DIR, or None if it is not set"""
+    directory = os.environ.get("DEVFLOW_CACHE_DIR")
+    if not directory:
+        return None
+    max_size = int(os.environ.get("DEVFLOW_CACHE_SIZE", DEFAULT_SIZE))
+    cache = _caches.get(directory)
+    if cache is None or cache.max_size != max_size:
+        cache = _caches[directory] = VersionCache(directory, max_size)
+    return cache
@@ -1,5 +1,9 @@
 import os
 import re
+import sys
+import json
+import shlex
+import tempfile
 
 import logging
 logging.basicConfig()
@@ -7,13 +11,16 @@ logging.basicConfig()
 from argparse import ArgumentParser
 
 os.environ["GIT_PYTHON_TRACE"] = "full"
-from devflow import utils, versioning, RC_RE
+from devflow import utils, versioning, state, RC_RE, BASE_VERSION_FILE
+from devflow.refs import RefTransaction
+from devflow.tags import get_tag_index
 from devflow.version import __version__
-from devflow.autopkg import call
 from devflow.ui import query_action, query_user, query_yes_no
 from functools import wraps, partial
 from contextlib import contextmanager
 from git.exc import GitCommandError
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from sh import mktemp
 
 
@@ -23,77 +30,97 @@ def create_temp_file(suffix):
 
 
 def cleanup(func):
+    """Apply the ref updates of a flow, or roll them all back on failure
+
+    Flows that run as part of another flow, e.g. the steps of a plan, share
+    its transaction, which is applied or rolled back by the outermost flow.
+
+    """
     @wraps(func)
     def wrapper(self, *args, **kwargs):
-        try:
+        if self.running:
             return func(self, *args, **kwargs)
+        self.running = True
+        try:
+            result = func(self, *args, **kwargs)
+            self.refs.commit(checkout=self.final_branch)
+            # Ref updates do not run the hooks that keep the state
+            state.refresh_state(self.repo)
+            return result
         except:
             self.log.debug("Unexpected ERROR. Cleaning up repository...")
+            self.refs.rollback()
             self.repo.git.reset("--hard", "HEAD")
-            self.repo.git.checkout(self.start_branch)
-            self.repo.git.reset("--hard", self.start_hex)
-            for branch in self.new_branches:
-                self.repo.git.branch("-D", branch)
-            for tag in self.new_tags:
-                self.repo.git.tag("-D", tag)
+            if self.repo.active_branch.name != self.start_branch:
+                self.repo.git.checkout(self.start_branch)
             raise
+        finally:
+            self.running = False
+            self.final_branch = None
     return wrapper
 
 
 @contextmanager
 def conflicts():
+    # Records whether the user had to resolve conflicts
+    outcome = {"conflicts": False}
     try:
-        yield
+        yield outcome
     except GitCommandError as e:
         if e.status != 128:
+            outcome["conflicts"] = True
             print "An error occured. Resolve it and type 'exit 0'"
             tmpbashrc=create_temp_file("bashrc")
             f = open(tmpbashrc, 'w')
             f.write("source $HOME/.bashrc ; export PS1=(Conflict)\"$PS1\"")
             f.close()
-            call('bash --rcfile %s' % tmpbashrc)
+            utils.call('bash --rcfile %s' % tmpbashrc)
             os.unlink(tmpbashrc)
         else:
             raise
 
-def get_release_version(develop_version):
-    version = develop_version.rstrip('next')
-    parts = version.split('.')
-    major_version = int(parts[0])
-    minor_version = int(parts[1])
-    #return str(major_version) + '.' + str(minor_version+1) + 'rc1'
-    return str(major_version) + '.' + str(minor_version+1)
+def get_release_version(develop_version, latest_release=None):
+    numbers = versioning.Version.parse(develop_version).numbers
+    # Do not suggest a version that has already been released
+    if latest_release is not None and \
+       latest_release.numbers[:2] > numbers[:2]:
+        numbers = latest_release.numbers
+    return "%d.%d" % (numbers[0], numbers[1] + 1)
 
 def get_develop_version_from_release(release_version):
-    #version = re.sub('rc[0-9]+$', '', release_version)
-    version = release_version
-    parts = version.split('.')
-    major_version = int(parts[0])
-    minor_version = int(parts[1])
-    return str(major_version) + '.' + str(minor_version+1) + 'next'
-
-def get_hotfix_version(version):
-    parts = version.split('.')
-    major_version = int(parts[0])
-    minor_version = int(parts[1])
-    if (len(parts) > 2):
-        hotfix_version = int(parts[2])
-    else:
-        hotfix_version = 0
-
-    return str(major_version) + '.' + str(minor_version) + '.'\
-            + str(hotfix_version+1)
+    numbers = versioning.Version.parse(release_version).numbers
+    return "%d.%dnext" % (numbers[0], numbers[1] + 1)
+
+def get_hotfix_version(version, latest_hotfix=None):
+    numbers = versioning.Version.parse(version).numbers
+    if latest_hotfix is not None and latest_hotfix.numbers > numbers:
+        numbers = latest_hotfix.numbers
+    hotfix_version = numbers[2] if len(numbers) > 2 else 0
+    return "%d.%d.%d" % (numbers[0], numbers[1], hotfix_version + 1)
+
+def suite_branch(branch, codename):
+    """Return the name of a debian branch for a distribution"""
+    if codename is None:
+        return branch
+    return "%s-%s" % (branch, codename)
+
 
 class GitManager(object):
     def __init__(self):
         self.repo = utils.get_repository()
         self.start_branch = self.repo.active_branch.name
-        self.start_hex = self.repo.head.log()[-1].newhexsha
+        # Resolve HEAD directly, instead of parsing the whole reflog
+        self.start_hex = self.repo.head.commit.hexsha
         self.log = logging.getLogger("")
         self.log.setLevel(logging.DEBUG)
         self.log.info("Repository: %s. HEAD: %s", self.repo, self.start_hex)
-        self.new_branches = []
-        self.new_tags = []
+        # All ref changes go through this transaction, which is applied when
+        # a flow succeeds and rolled back when it fails
+        self.refs = RefTransaction(self.repo)
+        # Branch to check out after the ref changes have been applied
+        self.final_branch = None
+        # Whether a flow is running
+        self.running = False
         #self.repo.git.pull("origin")
 
     def get_branch(self, mode, version):
@@ -120,14 +147,15 @@ class GitManager(object):
 
     def __print_cleanup(self, branches):
         print "To remove obsolete branches run:"
-        for b in branches:
-            print "git branch -D %s" % b
+        print "git branch -D %s" % " ".join(branches)
 
 
     def __cleanup_branches(self, branches):
-        repo = self.repo
+        # Deletions are applied together with the other ref changes, in a
+        # single transaction
         for b in branches:
-            repo.git.branch("-D", b)
+            self._branch_sha(b)
+            self.refs.delete("refs/heads/" + b)
 
     def cleanup_branches(self, branches, args, default=False):
         if args.cleanup is not None:
@@ -153,13 +181,223 @@ class GitManager(object):
         self.doit(action_yes=edit_action, question=question, args=args,
                   default=default)
 
+    def _branch_sha(self, branch):
+        """Return the tip of a branch, including pending changes"""
+        sha = self.refs.resolve("refs/heads/" + branch)
+        if sha is None:
+            raise ValueError("Branch %s does not exist." % branch)
+        return sha
+
+    def _create_branch(self, branch, start_branch):
+        if self.refs.resolve("refs/heads/" + branch) is not None:
+            raise ValueError("Branch %s already exists." % branch)
+        self.refs.update("refs/heads/" + branch,
+                         self._branch_sha(start_branch))
+
+    def existing_branches(self, branches):
+        return [b for b in branches
+                if self.refs.resolve("refs/heads/" + b) is not None]
+
+    def _create_tag(self, tag, branch):
+        if self.refs.resolve("refs/tags/" + tag) is not None:
+            raise ValueError("Tag %s already exists." % tag)
+        self.refs.update("refs/tags/" + tag, self._branch_sha(branch))
+
     def _merge_branches(self, branch_to, branch_from):
+        """Merge two branches.
+
+        Returns what happened: 'up to date', 'merged' or 'merged, with
+        conflicts'.
+
+        """
+        to_sha = self._branch_sha(branch_to)
+        if self._merge_refs(branch_to, branch_from):
+            merged = self._branch_sha(branch_to) != to_sha
+            return "merged" if merged else "up to date"
+        # Conflicts must be resolved in the working tree, so apply the
+        # pending changes first
         repo = self.repo
+        self.refs.commit()
         cur_branch = repo.active_branch.name
         repo.git.checkout(branch_to)
-        with conflicts():
+        with conflicts() as outcome:
             repo.git.merge("--no-ff", branch_from)
+        self.refs.reload("refs/heads/" + branch_to)
         repo.git.checkout(cur_branch)
+        if outcome["conflicts"]:
+            return "merged, with conflicts"
+        merged = self._branch_sha(branch_to) != to_sha
+        return "merged" if merged else "up to date"
+
+    def _merge_refs(self, branch_to, branch_from):
+        """Merge two branches without touching the working tree.
+
+        The merge is computed with 'git merge-tree' and the merge commit is
+        created with 'git commit-tree'. Returns False if the merge can not
+        be done this way, either because of conflicts or because git is too
+        old, in which case nothing is changed.
+
+        """
+        if self.repo.git.version_info < (2, 38):
+            return False
+        to_sha = self._branch_sha(branch_to)
+        commit = self._merge_commit(branch_to, branch_from, to_sha,
+                                    self._branch_sha(branch_from))
+        if commit is None:
+            self.log.info("Merge of %s into %s has conflicts",
+                          branch_from, branch_to)
+            return False
+        if commit != to_sha:
+            self.refs.update("refs/heads/" + branch_to, commit)
+        return True
+
+    def _merge_commit(self, branch_to, branch_from, to_sha, from_sha):
+        """Create the merge commit of two branches, without updating any ref.
+
+        Returns the new tip of 'branch_to', or None if the merge conflicts.
+
+        """
+        repo = self.repo
+        if repo.is_ancestor(from_sha, to_sha):
+            # Already up to date
+            return to_sha
+        tree, conflicting = self._merge_tree(to_sha, from_sha)
+        if conflicting:
+            return None
+        message = "Merge branch '%s'" % branch_from
+        if branch_to != "master":
+            message += " into %s" % branch_to
+        return repo.git.commit_tree(tree, "-p", to_sha, "-p", from_sha,
+                                    "-m", message)
+
+    def _merge_fanout(self, merges):
+        """Merge several independent pairs of branches.
+
+        'merges' is a list of (branch_to, branch_from) tuples, e.g. one for
+        each distribution. The merges are computed in memory in parallel and
+        the branches are updated without checking them out. Merges that
+        conflict, or all merges with git older than 2.38, are then done one
+        by one in the working tree. The outcome of every merge is reported.
+
+        """
+        report = []
+        jobs = []
+        for branch_to, branch_from in merges:
+            missing = [b for b in (branch_to, branch_from)
+                       if self.refs.resolve("refs/heads/" + b) is None]
+            if missing:
+                report.append((branch_to, branch_from,
+                               "skipped, %s does not exist" % missing[0]))
+            else:
+                jobs.append((branch_to, branch_from,
+                             self._branch_sha(branch_to),
+                             self._branch_sha(branch_from)))
+
+        if jobs and self.repo.git.version_info >= (2, 38):
+            pool = ThreadPool(min(len(jobs), cpu_count()))
+            try:
+                commits = pool.map(lambda job: self._merge_commit(*job), jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            # Without 'git merge-tree', every merge is done in the working
+            # tree
+            commits = [None] * len(jobs)
+
+        remaining = []
+        for (branch_to, branch_from, to_sha, _), commit in zip(jobs, commits):
+            if commit is None:
+                remaining.append((branch_to, branch_from))
+            elif commit == to_sha:
+                report.append((branch_to, branch_from, "up to date"))
+            else:
+                self.refs.update("refs/heads/" + branch_to, commit)
+                report.append((branch_to, branch_from, "merged"))
+        for branch_to, branch_from in remaining:
+            result = self._merge_branches(branch_to, branch_from)
+            report.append((branch_to, branch_from, result))
+
+        for branch_to, branch_from, result in report:
+            print "%s -> %s: %s" % (branch_from, branch_to, result)
+
+    def _merge_tree(self, to_sha, from_sha):
+        """Compute the merge of two commits in memory with 'git merge-tree'.
+
+        Returns a tuple with the hexsha of the resulting tree and the list of
+        the conflicting paths.
+
+        """
+        status, output, stderr = self.repo.git.merge_tree(
+            "--write-tree", "--no-messages", "--name-only", to_sha, from_sha,
+            with_extended_output=True, with_exceptions=False)
+        if status not in (0, 1):
+            raise GitCommandError(["git", "merge-tree", to_sha, from_sha],
+                                  status, stderr)
+        lines = output.split("\n")
+        return lines[0], sorted(set(l for l in lines[1:] if l))
+
+    def predict_conflicts(self, merges, tips=None):
+        """Report the conflicts of a list of merges, before doing any of them.
+
+        'merges' is a list of (branch_to, branch_from) tuples. All merges are
+        computed in memory from the current tips of the branches, or the
+        commits given for them in 'tips', without changing any ref or the
+        working tree. Returns True if all merges are clean.
+
+        """
+        tips = tips or {}
+        repo = self.repo
+        if repo.git.version_info < (2, 38):
+            print "Can not predict merge conflicts: git >= 2.38 is required."
+            return False
+        clean = True
+        for branch_to, branch_from in merges:
+            if self.refs.resolve("refs/heads/" + branch_to) is None or \
+               self.refs.resolve("refs/heads/" + branch_from) is None:
+                continue
+            to_sha = tips.get(branch_to) or self._branch_sha(branch_to)
+            from_sha = tips.get(branch_from) or self._branch_sha(branch_from)
+            if repo.is_ancestor(from_sha, to_sha):
+                continue
+            _, conflicting = self._merge_tree(to_sha, from_sha)
+            if conflicting:
+                clean = False
+                print "Merging %s into %s conflicts in:" % (branch_from,
+                                                           branch_to)
+                for path in conflicting:
+                    print "    %s" % path
+        if clean:
+            print "No merge conflicts."
+        return clean
+
+    def debian_suites(self):
+        """Return the distributions that have their own debian branches.
+
+        Besides the plain debian branches, a distribution is maintained for
+        every 'debian-develop-<codename>' branch, with branches named
+        'debian-<codename>', 'debian-release-<version>-<codename>', etc.
+        None stands for the plain debian branches.
+
+        """
+        prefix = "refs/heads/debian-develop-"
+        suites = sorted(ref[len(prefix):] for ref in self.refs.snapshot()
+                        if ref.startswith(prefix))
+        if self.refs.resolve("refs/heads/debian-develop") is not None:
+            suites.insert(0, None)
+        return suites
+
+    def suite_merges(self, branch_to, branch_from):
+        """Return the merges of two debian branches for every distribution"""
+        return [(suite_branch(branch_to, s), suite_branch(branch_from, s))
+                for s in self.debian_suites()]
+
+    def merge_fanout(self, merges, args, default=True):
+        action = partial(self._merge_fanout, merges)
+        question = "Merge branches %s ?" % \
+                   ", ".join("%s to %s" % (f, t) for t, f in merges)
+        self.doit(action_yes=action, question=question, args=args,
+                  default=default)
 
     def merge_branches(self, branch_to, branch_from, args, default=True):
         action = partial(self._merge_branches, branch_to, branch_from)
@@ -169,55 +407,85 @@ class GitManager(object):
 
     def edit_changelog(self, branch, base_branch=None):
         repo = self.repo
-        if not branch in repo.branches:
-            raise ValueError("Branch %s does not exist." % branch)
-        if base_branch and not base_branch in repo.branches:
-            raise ValueError("Branch %s does not exist." % base_branch)
-
-        repo.git.checkout(branch)
-        topdir = repo.working_dir
-        changelog = os.path.join(topdir, "Changelog")
-
-        lines = []
-        lines.append("#Changelog for %s\n" % branch)
+        branch_sha = self._branch_sha(branch)
         if base_branch:
-            commits = repo.git.rev_list("%s..%s" % (base_branch, branch)).split("\n")
-            for c in commits:
-                commit = repo.commit(c)
-                lines.append("* " + commit.message.split("\n")[0])
-        lines.append("\n")
-
-        f = open(changelog, 'rw+')
-        lines.extend(f.readlines())
-        f.seek(0)
-        f.truncate(0)
-        f.writelines(lines)
-        f.close()
+            base_sha = self._branch_sha(base_branch)
+
+        # Edit a copy of the changelog, so that the branch does not have to
+        # be checked out. The new entries and the current changelog are
+        # streamed into a new file, which then replaces the copy atomically.
+        changelog = create_temp_file("Changelog")
+        new_changelog = changelog + ".new"
+        with open(new_changelog, "w") as f:
+            self._write_changelog(f, branch, branch_sha,
+                                  base_sha if base_branch else None)
+        os.rename(new_changelog, changelog)
 
         editor = os.getenv('EDITOR')
         if not editor:
             editor = 'vim'
-        call("%s %s" % (editor, changelog))
-        repo.git.add(changelog)
-        repo.git.commit(m="Update changelog")
+        utils.call("%s %s" % (editor, changelog))
+        with open(changelog, "rb") as f:
+            utils.commit_file(repo, branch, "Changelog", f,
+                              "Update changelog", self.refs)
+        os.unlink(changelog)
         print "Updated changelog on branch %s" % branch
 
+    def _write_changelog(self, f, branch, branch_sha, base_sha=None):
+        """Write the changelog of a branch, with the subjects of the commits
+        since 'base_sha' as new entries, before it is edited"""
+        f.write("#Changelog for %s\n" % branch)
+        if base_sha:
+            utils.write_commit_subjects(
+                self.repo, f, "%s..%s" % (base_sha, branch_sha), prefix="* ")
+        f.write("\n")
+        utils.copy_file_at(self.repo, branch_sha, "Changelog", f)
+
+    def _simulate_end_release(self, branch, base_branch, args):
+        """Create the commits that finishing a release adds before merging it.
+
+        The changelog entries, as they are before being edited, and the
+        version bump that strips the release candidate suffix are committed
+        on top of the release branch, without updating any ref. Returns the
+        hexsha of the simulated tip.
+
+        """
+        repo = self.repo
+        sha = self._branch_sha(branch)
+        if args.edit_changelog is not False:
+            f = tempfile.TemporaryFile()
+            self._write_changelog(f, branch, sha,
+                                  self._branch_sha(base_branch))
+            sha = utils.create_file_commit(repo, sha, "Changelog", f,
+                                           "Update changelog")
+        content = utils.read_file_at(repo, sha, BASE_VERSION_FILE)
+        release_version = versioning.parse_base_version(content)
+        if re.match('.*'+RC_RE, release_version):
+            new_version = re.sub(RC_RE, '', release_version)
+            content = versioning.replace_base_version(content,
+                                                      release_version,
+                                                      new_version)
+            sha = utils.create_file_commit(repo, sha, BASE_VERSION_FILE,
+                                           content,
+                                           "Bump version to %s" % new_version)
+        return sha
+
     @cleanup
     def start_release(self, args):
         repo = self.repo
         upstream = "develop"
         debian = "debian-develop"
-        repo.git.checkout(upstream)
 
-        vcs = utils.get_vcs_info()
-        develop_version = versioning.get_base_version(vcs)
+        develop_version = versioning.get_base_version_at(
+            repo, self._branch_sha(upstream))
         if not args.version:
-            version = get_release_version(develop_version)
+            latest_release = get_tag_index(repo).latest_release()
+            version = get_release_version(develop_version, latest_release)
             if not args.defaults:
                 version = query_user("Release version", default=version)
         else:
             #validate version?
-            pass
+            version = args.version
         rc_version = "%src1" % version
         new_develop_version = "%snext" % version
 
@@ -225,71 +493,59 @@ class GitManager(object):
         debian_branch = self.get_debian_branch("release", version)
 
         #create release branch
-        repo.git.branch(upstream_branch, upstream)
-        self.new_branches.append(upstream_branch)
-        repo.git.checkout(upstream_branch)
-        versioning.bump_version(rc_version)
+        self._create_branch(upstream_branch, upstream)
+        versioning.bump_version(rc_version, upstream_branch, self.refs)
 
-        #create debian release branch
-        repo.git.checkout(debian)
-        repo.git.branch(debian_branch, debian)
-        self.new_branches.append(debian_branch)
-
-        repo.git.checkout(upstream_branch)
-        repo.git.checkout(debian)
+        #create debian release branches
+        for suite in self.debian_suites():
+            self._create_branch(suite_branch(debian_branch, suite),
+                                suite_branch(debian, suite))
 
         #bump develop version
-        repo.git.checkout(upstream)
-        versioning.bump_version(new_develop_version)
-
-        repo.git.checkout(upstream_branch)
+        versioning.bump_version(new_develop_version, upstream, self.refs)
 
+        self.final_branch = upstream_branch
 
     @cleanup
     def start_hotfix(self, args):
         repo = self.repo
         upstream = "master"
         debian = "debian"
-        repo.git.checkout(upstream)
-        #maybe provide major.minor version, find the latest release/hotfix and
-        #branch from there ?
+        #maybe provide major.minor version, and branch from the latest
+        #release/hotfix of that version?
 
-        vcs = utils.get_vcs_info()
-        version = versioning.get_base_version(vcs)
+        version = versioning.get_base_version_at(repo,
+                                                 self._branch_sha(upstream))
         if not args.version:
-            version = get_hotfix_version(version)
+            numbers = versioning.Version.parse(version).numbers
+            latest_hotfix = get_tag_index(repo).latest_hotfix(*numbers[:2])
+            version = get_hotfix_version(version, latest_hotfix)
             if not args.defaults:
                 version = query_user("Hotfix version", default=version)
         else:
             #validate version?
-            pass
+            version = args.version
 
         rc_version = "%src1" % version
-        new_develop_version = "%snext" % version
 
         upstream_branch = self.get_branch("hotfix", version)
         debian_branch = self.get_debian_branch("hotfix", version)
 
         #create hotfix branch
-        repo.git.branch(upstream_branch, upstream)
-        self.new_branches.append(upstream_branch)
-        repo.git.checkout(upstream_branch)
-        versioning.bump_version(rc_version)
-
-        #create debian hotfix branch
-        repo.git.checkout(debian)
-        repo.git.branch(debian_branch, debian)
-        self.new_branches.append(debian_branch)
+        self._create_branch(upstream_branch, upstream)
+        versioning.bump_version(rc_version, upstream_branch, self.refs)
 
-        repo.git.checkout(upstream_branch)
-        repo.git.checkout(debian)
+        #create debian hotfix branches
+        for suite in self.debian_suites():
+            if self.refs.resolve("refs/heads/" +
+                                 suite_branch(debian, suite)) is None:
+                print "Skipping branch %s, which does not exist" %\
+                      suite_branch(debian, suite)
+                continue
+            self._create_branch(suite_branch(debian_branch, suite),
+                                suite_branch(debian, suite))
 
-        #bump develop version. Ask first or verify we have the same
-        #major.minornext?
-        #repo.git.checkout(upstream)
-        #versioning.bump_version(new_develop_version)
-
-        repo.git.checkout(upstream_branch)
+        self.final_branch = upstream_branch
 
     @cleanup
     def end_release(self, args):
@@ -304,94 +560,290 @@ class GitManager(object):
         tag = upstream_branch
         debian_tag = "debian/" + tag
 
+        debian_merges = self.suite_merges(debian_master, debian_branch)
+        debian_develop_merges = self.suite_merges(debian, debian_branch)
+        merges = [(master, upstream_branch), (upstream, upstream_branch)]
+        merges += debian_merges + debian_develop_merges
+        tips = {}
+        if args.check:
+            # The release branch is merged after the changelog and version
+            # commits that finishing it adds
+            tips[upstream_branch] = self._simulate_end_release(
+                upstream_branch, upstream, args)
+        clean = self.predict_conflicts(merges, tips)
+        if args.check:
+            return 0 if clean else 1
+
         edit_action = partial(self.edit_changelog, upstream_branch, "develop")
         self.check_edit_changelog(edit_action, args, default=True)
 
-        vcs = utils.get_vcs_info()
-        release_version = versioning.get_base_version(vcs)
+        release_version = versioning.get_base_version_at(
+            repo, self._branch_sha(upstream_branch))
         if re.match('.*'+RC_RE, release_version):
             new_version = re.sub(RC_RE, '', release_version)
-            versioning._bump_version(new_version, vcs)
+            versioning._bump_version(new_version, upstream_branch, self.refs)
 
         #merge to master
         self._merge_branches(master, upstream_branch)
-        self._merge_branches(debian_master, debian_branch)
+        self._merge_fanout(debian_merges)
 
         #create tags
-        repo.git.checkout(master)
-        repo.git.tag("%s" % tag)
-        repo.git.checkout(debian)
-        repo.git.tag("%s" % debian_tag)
+        self._create_tag(tag, master)
+        for suite in self.debian_suites():
+            self._create_tag(suite_branch(debian_tag, suite),
+                             suite_branch(debian, suite))
 
         #merge release changes to upstream
         self.merge_branches(upstream, upstream_branch, args, default=True)
-        self.merge_branches(debian, debian_branch, args, default=True)
+        self.merge_fanout(debian_develop_merges, args, default=True)
 
-        repo.git.checkout(upstream)
+        self.final_branch = upstream
 
-        branches = [upstream_branch, debian_branch]
+        branches = [upstream_branch] + self.existing_branches(
+            [f for _, f in debian_merges])
         self.cleanup_branches(branches, args, default=True)
 
     @cleanup
     def end_hotfix(self, args):
         version = args.version
 
-        repo = self.repo
         upstream = "master"
         debian = "debian"
         upstream_branch = self.get_branch("hotfix", version)
         debian_branch = self.get_debian_branch("hotfix", version)
 
+        debian_merges = self.suite_merges(debian, debian_branch)
+        merges = [(upstream, upstream_branch)] + debian_merges
+        clean = self.predict_conflicts(merges)
+        if args.check:
+            return 0 if clean else 1
+
         #create tags?
 
         self._merge_branches(upstream, upstream_branch)
-        self._merge_branches(debian, debian_branch)
+        self._merge_fanout(debian_merges)
 
-        repo.git.checkout(upstream)
+        self.final_branch = upstream
 
-        branches = [upstream_branch, debian_branch]
+        branches = [upstream_branch] + self.existing_branches(
+            [f for _, f in debian_merges])
         self.cleanup_branches(branches, args, default=True)
 
     @cleanup
     def start_feature(self, args):
         feature_name = args.feature_name
-        repo = self.repo
         feature_upstream = "feature-%s" % feature_name
         feature_debian = "debian-%s" % feature_upstream
-        repo.git.branch(feature_upstream, "develop")
-        self.new_branches.append(feature_upstream)
-        repo.git.branch(feature_debian, "debian-develop")
-        self.new_branches.append(feature_debian)
+        self._create_branch(feature_upstream, "develop")
+        self._create_branch(feature_debian, "debian-develop")
 
     @cleanup
     def end_feature(self, args):
         feature_name = args.feature_name
-        repo = self.repo
         feature_upstream = "feature-%s" % feature_name
-        if not feature_upstream in repo.branches:
-            raise ValueError("Branch %s does not exist." % feature_upstream)
+        self._branch_sha(feature_upstream)
         feature_debian = "debian-%s" % feature_upstream
+        has_debian = self.refs.resolve("refs/heads/" + feature_debian)
 
         edit_action = partial(self.edit_changelog, feature_upstream, "develop")
         self.check_edit_changelog(edit_action, args, default=True)
 
         #merge to develop
         self._merge_branches("develop", feature_upstream)
-        if feature_debian in repo.branches:
+        if has_debian:
             self._merge_branches("debian-develop", feature_debian)
-        repo.git.checkout("develop")
+        self.final_branch = "develop"
 
         branches = [feature_upstream]
-        if feature_debian in repo.branches:
+        if has_debian:
             branches.append(feature_debian)
         self.cleanup_branches(branches, args, default=True)
 
+    def find_merged_branches(self):
+        """Return the feature, release and hotfix branches that are merged.
+
+        The branches that are fully merged into any of develop, master, or
+        the debian-develop and debian branches of every distribution are
+        found with a single 'git for-each-ref --merged' walk. Branches
+        without any commits of their own are kept: their tip is on the
+        first-parent history of a base, i.e. it is the point they were
+        forked from, while merged branches are reached only through merge
+        commits.
+
+        """
+        refs = self.refs
+        suites = [None] + [s for s in self.debian_suites() if s is not None]
+        bases = ["develop", "master"]
+        for suite in suites:
+            bases.append(suite_branch("debian-develop", suite))
+            bases.append(suite_branch("debian", suite))
+        bases = [b for b in bases
+                 if refs.resolve("refs/heads/" + b) is not None]
+        if not bases:
+            return []
+        fork_points = set(self.repo.git.rev_list(
+            "--first-parent", *[self._branch_sha(b) for b in bases]).split())
+        # Several --merged options select the refs merged into any of them
+        options = ["--merged=" + b for b in bases]
+        output = self.repo.git.for_each_ref("--format=%(refname:short)",
+                                            "refs/heads/", *options)
+        merged = set(output.split())
+
+        branches = []
+        for branch in sorted(merged):
+            if branch.split("-")[0] not in ["feature", "release", "hotfix"]:
+                continue
+            if branch == self.start_branch or \
+               self._branch_sha(branch) in fork_points:
+                continue
+            branches.append(branch)
+            for debian_branch in [suite_branch("debian-" + branch, s)
+                                  for s in suites]:
+                if debian_branch in merged:
+                    branches.append(debian_branch)
+                elif refs.resolve("refs/heads/" + debian_branch):
+                    print "Keeping branch %s, which is not merged" %\
+                          debian_branch
+        return branches
+
+    @cleanup
+    def init_repo(self, args):
+        """Create the develop branch from master, if it does not exist.
+
+        With --hooks, the git hooks that maintain the version state of the
+        working tree are installed as well.
+
+        """
+        master = args.master or "master"
+        develop = args.develop or "develop"
+        master_sha = self.refs.resolve("refs/heads/" + master)
+        if master_sha is None:
+            raise ValueError("Branch '%s' does not exist" % master)
+        if self.refs.resolve("refs/heads/" + develop) is None:
+            self.refs.update("refs/heads/" + develop, master_sha)
+            print "Created branch '%s' from '%s'" % (develop, master)
+        if args.hooks:
+            for hook in state.install_hooks(self.repo):
+                print "Installed hook '%s'" % hook
+            state.update_state(self.repo)
+
+    @cleanup
+    def cleanup_merged(self, args):
+        if not args.merged:
+            print "Specify the branches to remove, e.g. --merged"
+            return 1
+        branches = self.find_merged_branches()
+        if not branches:
+            print "No merged branches to remove."
+            return
+        self.cleanup_branches(branches, args, default=True)
+
+
+    def _debian_branch_of(self, branch, heads, codename):
+        if branch == "master":
+            candidates = ["debian-" + codename, "debian"]
+        else:
+            candidates = ["debian-%s-%s" % (branch, codename),
+                          "debian-" + branch]
+        for candidate in candidates:
+            if candidate in heads:
+                return candidate
+        return None
+
+    def status(self, args):
+        """Print the live branches, their versions and how they diverge.
+
+        All refs are read from a single snapshot, the divergence of every
+        branch is computed with a single walk of the history of all branches
+        and the version files are read directly from the object database.
+
+        """
+        repo = self.repo
+        prefix = "refs/heads/"
+        heads = dict((ref[len(prefix):], sha)
+                     for ref, sha in self.refs.snapshot().items()
+                     if ref.startswith(prefix))
+        codename = utils.get_distribution_codename()
+        rows = [b for b in ["master", "develop"] if b in heads]
+        for branch in sorted(heads):
+            info = utils.classify_branch(branch)
+            if not info.debian and \
+               info.type in ["feature", "release", "hotfix"]:
+                rows.append(branch)
+        debian = dict((b, self._debian_branch_of(b, heads, codename))
+                      for b in rows)
+
+        names = sorted(set(rows) | set(b for b in debian.values() if b))
+        bits = dict((name, 1 << i) for i, name in enumerate(names))
+        counts, parents = utils.walk_history(repo,
+                                             [heads[n] for n in names])
+
+        def divergence(branch, other):
+            if other is None or other not in bits or other == branch:
+                return "-"
+            return "+%d/-%d" % (
+                utils.count_commits(counts, bits[branch], bits[other]),
+                utils.count_commits(counts, bits[other], bits[branch]))
+
+        fmt = "%-32s %-12s %-32s %-10s %-10s %s"
+        print fmt % ("BRANCH", "VERSION", "SNAPSHOT", "DEVELOP", "MASTER",
+                     "DEBIAN")
+        for branch in rows:
+            sha = heads[branch]
+            base_version = snapshot = "-"
+            try:
+                data = repo.git.get_object_data("%s:%s" %
+                                                (sha, BASE_VERSION_FILE))[3]
+                base_version = versioning.parse_base_version(data)
+                info = utils.vcs_info(
+                    branch=branch,
+                    revid=utils.format_commit_id(sha, parents[sha], branch),
+                    revno=utils.count_commits(counts, bits[branch]),
+                    toplevel=repo.working_dir, name="", email="")
+                snapshot = versioning.python_version(base_version, info,
+                                                     "snapshot")
+            except ValueError:
+                pass
+            print fmt % (branch, base_version, snapshot,
+                         divergence(branch, "develop"),
+                         divergence(branch, "master"),
+                         divergence(branch, debian[branch]))
+
+    @cleanup
+    def run_plan(self, args):
+        """Run a list of flow operations as a single operation.
+
+        The plan is a JSON list with the command line arguments of every
+        operation, either as a list or as a string. All operations are
+        parsed before any of them runs. They share the same ref transaction,
+        so the first failure rolls back the whole plan.
+
+        """
+        with open(args.plan) as f:
+            plan = json.load(f)
+        parser = get_parser()
+        steps = []
+        for step in plan:
+            if isinstance(step, basestring):
+                step = shlex.split(step)
+            step_args = parser.parse_args([str(a) for a in step])
+            if step_args.func == "run_plan":
+                raise ValueError("Plans can not run other plans")
+            step_args.defaults = step_args.defaults or args.defaults
+            steps.append((" ".join(step), step_args))
+
+        for num, (step, step_args) in enumerate(steps, 1):
+            print "Running step %d/%d: %s" % (num, len(steps), step)
+            result = getattr(self, step_args.func)(step_args)
+            if result:
+                raise RuntimeError("Step '%s' failed" % step)
+
 
 def refhead(repo):
-    return repo.head.log[-1].newhexsha
+    return utils.read_reflog_tail(repo)[-1].newhexsha
 
 
-def main():
+def get_parser():
     parser = ArgumentParser(description="Devflow tool")
     parser.add_argument('-V', '--version', action='version',
             version='devflow-flow %s' % __version__)
@@ -407,6 +859,8 @@ def main():
             help="Master branch")
     init_parser.add_argument('-d', '--develop', type=str, nargs='?',
             help="Develop branch")
+    init_parser.add_argument('--hooks', action='store_true', default=False,
+            help="Install git hooks that keep the version state up to date")
     init_parser.set_defaults(func='init_repo')
 
 
@@ -452,6 +906,11 @@ def main():
             help="Do not edit the changelog")
     release_finish_parser.add_argument('--no-cleanup', action='store_const',
             const=True, dest='cleanup', help="Do not cleanup branches")
+    release_finish_parser.add_argument('--check', action='store_true',
+            default=False,
+            help="Only report merge conflicts, without changing anything."
+                 " The changelog entries are checked as they are before"
+                 " being edited")
 
     release_finish_parser.set_defaults(func='end_release')
 
@@ -477,15 +936,47 @@ def main():
             help="Do not edit the changelog")
     hotfix_finish_parser.add_argument('--no-cleanup', action='store_const',
             const=True, dest='cleanup', help="Do not cleanup branches")
+    hotfix_finish_parser.add_argument('--check', action='store_true',
+            default=False,
+            help="Only report merge conflicts, without changing anything")
     hotfix_finish_parser.set_defaults(func='end_hotfix')
 
 
 
+    cleanup_parser = subparsers.add_parser('cleanup',
+            help="Remove obsolete branches")
+    cleanup_parser.add_argument('--merged', action='store_true',
+            default=False,
+            help="Remove the feature, release and hotfix branches, and"
+                 " their debian branches, that are merged into any of"
+                 " develop, master, debian-develop or debian")
+    cleanup_parser.set_defaults(func='cleanup_merged', cleanup=None)
+
+
+    status_parser = subparsers.add_parser('status',
+            help="Show the live branches, their versions and how far ahead"
+                 " or behind develop, master and their debian branches"
+                 " they are")
+    status_parser.set_defaults(func='status')
+
+
+    run_parser = subparsers.add_parser('run',
+            help="Run the flow operations of a plan as a single operation")
+    run_parser.add_argument('plan', type=str,
+            help="JSON file with a list of operations, e.g."
+                 " [\"feature finish foo\", \"release start\"]")
+    run_parser.set_defaults(func='run_plan')
+
+    return parser
+
+
+def main():
+    parser = get_parser()
     args = parser.parse_args()
 
     gm = GitManager()
-    getattr(gm, args.func)(args)
+    return getattr(gm, args.func)(args)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,226 @@
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+
+"""Helper script for pruning old snapshot packages from a package pool.
+
+Every snapshot build produces packages with a new version, e.g.
+`0.14next~150~abc1234-1~wheezy`. This script groups the files of a pool by
+package, branch and codename, orders them using the Debian version ordering
+and keeps only the newest snapshots of each group, along with every release
+version. Pruned files are deleted, or moved to an archive directory.
+
+The branch of a snapshot is inferred from the base version it was built
+from. Release candidates are grouped with the release they lead to, e.g.
+`0.14~rc2~249~abc1234` belongs to the same group as `0.14~249~def5678`.
+Versions ending in 'next' come from the develop and feature branches and
+form a single group per base version.
+
+Only file names are inspected, so pruning is a single walk of the pool.
+
+"""
+
+import os
+import re
+import sys
+import shutil
+
+from collections import defaultdict
+from optparse import OptionParser
+
+from devflow.versioning import debian_version_key
+from devflow.publish import AptRepository, INDEX_DB
+from devflow.utils import print_green, print_red
+
+# <base>~<revno>~<revid>, the upstream part of a snapshot debian version
+SNAPSHOT_RE = re.compile(r"^(?P<base>.+)~(?P<revno>[0-9]+)~"
+                         r"(?P<revid>[0-9a-f]{7}(~[0-9a-f]{7})?)$")
+RC_RE = re.compile(r"~rc[0-9]+$")
+PACKAGE_SUFFIXES = (".deb", ".udeb", ".dsc", ".changes", ".buildinfo",
+                    ".tar.gz", ".tar.bz2", ".tar.xz", ".tar.zst")
+
+
+def parse_pool_filename(filename):
+    """Split a pool file name in (package, upstream, codename).
+
+    Returns None for files that are not packages or are not snapshots.
+    Files without a debian revision (e.g. orig tarballs) have no codename.
+
+    """
+    if not filename.endswith(PACKAGE_SUFFIXES):
+        return None
+    parts = filename.split("_")
+    if len(parts) < 2:
+        return None
+    package, version = parts[0], parts[1]
+    version = re.sub(r"\.(orig|debian)(-[^.]+)?\.tar\..*$|\.(dsc|tar\..*)$",
+                     "", version)
+    upstream, _, revision = version.rpartition("-") if "-" in version\
+        else (version, None, "")
+    if not SNAPSHOT_RE.match(upstream):
+        return None
+    codename = revision.rpartition("~")[2] if "~" in revision else None
+    return package, upstream, codename
+
+
+def snapshot_branch(upstream):
+    """Return the group of a snapshot, derived from its base version."""
+    base = SNAPSHOT_RE.match(upstream).group("base")
+    return RC_RE.sub("", base)
+
+
+def find_prunable(pool_dir, keep):
+    """Walk a pool and return the files of all but the 'keep' newest
+    snapshots of every package, branch and codename.
+
+    """
+    # (directory, package) -> upstream -> codename -> [files]
+    snapshots = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+    for dirpath, _, filenames in os.walk(pool_dir):
+        for filename in filenames:
+            parsed = parse_pool_filename(filename)
+            if parsed is None:
+                continue
+            package, upstream, codename = parsed
+            snapshots[(dirpath, package)][upstream][codename].append(
+                os.path.join(dirpath, filename))
+
+    key_cache = {}
+
+    def sort_key(upstream):
+        try:
+            return key_cache[upstream]
+        except KeyError:
+            key = key_cache[upstream] = debian_version_key(upstream)
+            return key
+
+    prunable = []
+    for versions in snapshots.values():
+        groups = defaultdict(list)
+        for upstream, codenames in versions.items():
+            for codename in codenames:
+                if codename is not None:
+                    groups[(snapshot_branch(upstream), codename)].append(
+                        upstream)
+        kept = set()
+        for (_, codename), upstreams in groups.items():
+            upstreams.sort(key=sort_key, reverse=True)
+            for upstream in upstreams[:keep]:
+                kept.add((upstream, codename))
+        for upstream, codenames in versions.items():
+            upstream_kept = any((upstream, c) in kept for c in codenames)
+            for codename, files in codenames.items():
+                if codename is None:
+                    # Files shared by all codenames, e.g. orig tarballs
+                    if not upstream_kept:
+                        prunable.extend(files)
+                elif (upstream, codename) not in kept:
+                    prunable.extend(files)
+    return prunable
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] pool_dir")
+    parser.add_option("-n", "--keep",
+                      dest="keep",
+                      type="int",
+                      default=5,
+                      help="Number of snapshots to keep for every package,"
+                           " branch and codename")
+    parser.add_option("--archive-dir",
+                      dest="archive_dir",
+                      default=None,
+                      help="Move pruned files to this directory, instead of"
+                           " deleting them")
+    parser.add_option("-r", "--repo-dir",
+                      dest="repo_dir",
+                      default=None,
+                      help="Prune the pool of a devflow-publish repository"
+                           " and update its indices")
+    parser.add_option("--dry-run",
+                      dest="dry_run",
+                      default=False,
+                      action="store_true",
+                      help="Only print the files that would be pruned")
+    (options, args) = parser.parse_args()
+
+    if options.repo_dir:
+        root = os.path.abspath(options.repo_dir)
+        pool_dir = os.path.join(root, "pool")
+        if not os.path.exists(os.path.join(root, INDEX_DB)):
+            parser.error("'%s' is not a devflow-publish repository" % root)
+    elif len(args) == 1:
+        root = pool_dir = os.path.abspath(args[0])
+    else:
+        parser.error("A single pool directory is required")
+
+    prunable = find_prunable(pool_dir, options.keep)
+    if options.dry_run:
+        for path in sorted(prunable):
+            print path
+        return
+
+    # The indices stop referencing the files before they are removed, so an
+    # interrupted run leaves only unreferenced files in the pool
+    if options.repo_dir:
+        repo = AptRepository(root)
+        try:
+            dists = repo.remove_files(os.path.relpath(path, root)
+                                      for path in prunable)
+        finally:
+            repo.close()
+        if dists:
+            print_green("Updated the indices of %s." % ", ".join(dists))
+
+    failed = 0
+    for path in prunable:
+        try:
+            if options.archive_dir:
+                target = os.path.join(options.archive_dir,
+                                      os.path.relpath(path, root))
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                # Copies the file if the archive is on another filesystem
+                shutil.move(path, target)
+            else:
+                os.unlink(path)
+        except (IOError, OSError, shutil.Error) as e:
+            print_red("Failed to prune '%s': %s" % (path, e))
+            failed += 1
+    print_green("Pruned %d files from '%s'." % (len(prunable) - failed,
+                                                 pool_dir))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,501 @@
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+
+"""Helper script for publishing autopkg packages to a local APT repository.
+
+Packages are hardlinked into the pool of the repository and the `Packages`,
+`Sources` and `Release` indices are updated incrementally: the control data
+of every published package is kept in an index database, new entries are
+appended to the existing indices and only the `Release` file is rewritten.
+The cost of publishing is thus proportional to the number of new packages,
+not to the size of the pool.
+
+The index database is committed only after the indices have been written.
+The distributions whose indices are being changed are recorded in a journal
+file beforehand, and if a run is interrupted, the next run rebuilds their
+indices from the database.
+
+The repository has the following layout:
+
+    <root>/pool/<component>/<prefix>/<source>/
+    <root>/dists/<distribution>/<component>/binary-<arch>/Packages{,.gz}
+    <root>/dists/<distribution>/<component>/source/Sources{,.gz}
+    <root>/dists/<distribution>/Release
+    <root>/db/index.db
+    <root>/db/dirty-<component>
+
+"""
+
+import os
+import sys
+import glob
+import gzip
+import time
+import errno
+import shutil
+import hashlib
+import sqlite3
+import subprocess
+
+from collections import OrderedDict
+from optparse import OptionParser
+
+from devflow.utils import print_green, print_red
+
+INDEX_DB = os.path.join("db", "index.db")
+HASHES = (("MD5Sum", "md5"), ("SHA1", "sha1"), ("SHA256", "sha256"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS binaries (
+    dist TEXT, component TEXT, arch TEXT, package TEXT, version TEXT,
+    filename TEXT, stanza TEXT,
+    PRIMARY KEY (dist, component, arch, package, version));
+CREATE TABLE IF NOT EXISTS sources (
+    dist TEXT, component TEXT, package TEXT, version TEXT,
+    directory TEXT, files TEXT, stanza TEXT,
+    PRIMARY KEY (dist, component, package, version));
+CREATE TABLE IF NOT EXISTS architectures (
+    dist TEXT, arch TEXT, PRIMARY KEY (dist, arch));
+CREATE INDEX IF NOT EXISTS binaries_filename ON binaries (filename);
+CREATE INDEX IF NOT EXISTS sources_directory ON sources (directory);
+"""
+
+
+def parse_control(text):
+    """Parse a single deb822 stanza, ignoring any PGP signature."""
+    fields = OrderedDict()
+    key = None
+    for line in text.splitlines():
+        if line.startswith("-----BEGIN PGP SIGNED"):
+            continue
+        if line.startswith("-----BEGIN PGP SIGNATURE"):
+            break
+        if line.startswith("Hash:") and not fields:
+            continue
+        if not line.strip():
+            if fields:
+                break
+            continue
+        if line[0] in " \t":
+            fields[key] += "\n" + line
+        else:
+            key, _, value = line.partition(":")
+            fields[key] = value.strip()
+    return fields
+
+
+def format_control(fields):
+    lines = []
+    for key, value in fields.items():
+        separator = "" if value.startswith("\n") else " "
+        lines.append("%s:%s%s\n" % (key, separator, value))
+    return "".join(lines) + "\n"
+
+
+def file_hashes(path):
+    """Return the size and the MD5/SHA1/SHA256 digests of a file."""
+    digests = [hashlib.new(name) for _, name in HASHES]
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            size += len(data)
+            for d in digests:
+                d.update(data)
+    return size, [d.hexdigest() for d in digests]
+
+
+def pool_directory(component, source):
+    prefix = source[:4] if source.startswith("lib") else source[0]
+    return os.path.join("pool", component, prefix, source)
+
+
+def link_file(src, dst):
+    """Hardlink a file into the pool, copying it across filesystems."""
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            if file_hashes(src) != file_hashes(dst):
+                raise RuntimeError("File '%s' already exists in the pool with"
+                                   " different contents" % dst)
+        elif e.errno == errno.EXDEV:
+            shutil.copy2(src, dst)
+        else:
+            raise
+
+
+class AptRepository(object):
+    def __init__(self, root, component="main", architectures=None):
+        self.root = os.path.abspath(root)
+        self.component = component
+        self.architectures = architectures or []
+        db_path = os.path.join(self.root, INDEX_DB)
+        if not os.path.isdir(os.path.dirname(db_path)):
+            os.makedirs(os.path.dirname(db_path))
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(SCHEMA)
+        # Distributions whose indices are being changed
+        self.journal = os.path.join(os.path.dirname(db_path),
+                                    "dirty-" + component)
+        # Index entries appended by this run, keyed by relative index path
+        self.pending = OrderedDict()
+        self.dirty_dists = set()
+        self.recover()
+
+    def recover(self):
+        """Rebuild the indices of an interrupted run from the database"""
+        try:
+            with open(self.journal) as f:
+                dists = f.read().split()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        print_red("Rebuilding the indices of an interrupted run: %s"
+                  % ", ".join(dists))
+        self.rebuild_indices(dists)
+        os.unlink(self.journal)
+
+    def _write_journal(self, dists):
+        with open(self.journal + ".new", "w") as f:
+            f.write("\n".join(sorted(dists)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.journal + ".new", self.journal)
+
+    def rebuild_indices(self, dists):
+        for dist in sorted(dists):
+            archs = self.get_architectures(dist)
+            for arch in archs:
+                self.rebuild_binary_index(dist, arch)
+            # Indices of architectures that were not committed are removed,
+            # so that they are created with all arch 'all' packages later
+            pattern = os.path.join(self.root, self.binary_index(dist, "*"))
+            for path in glob.glob(pattern) + glob.glob(pattern + ".gz"):
+                arch = os.path.basename(os.path.dirname(path))[7:]
+                if arch not in archs:
+                    os.unlink(path)
+            self.rebuild_source_index(dist)
+            self.write_release(dist)
+
+    def publish_build_dir(self, build_dir):
+        """Publish every upload described by a .changes file."""
+        changes_files = sorted(glob.glob(os.path.join(build_dir,
+                                                      "*.changes")))
+        if not changes_files:
+            raise RuntimeError("No .changes files found in '%s'" % build_dir)
+        published = 0
+        for changes in changes_files:
+            published += self.publish_changes(changes)
+        return published
+
+    def publish_changes(self, changes_path):
+        build_dir = os.path.dirname(os.path.abspath(changes_path))
+        with open(changes_path) as f:
+            changes = parse_control(f.read())
+        dist = changes["Distribution"].split()[0]
+        source = changes["Source"].split()[0]
+        directory = pool_directory(self.component, source)
+        pool_dir = os.path.join(self.root, directory)
+        if not os.path.isdir(pool_dir):
+            os.makedirs(pool_dir)
+        for arch in self.architectures:
+            self._add_architecture(dist, arch)
+
+        published = 0
+        for line in changes["Files"].splitlines():
+            if not line.strip():
+                continue
+            name = line.split()[-1]
+            link_file(os.path.join(build_dir, name),
+                      os.path.join(pool_dir, name))
+            filename = os.path.join(directory, name)
+            if name.endswith(".deb") or name.endswith(".udeb"):
+                published += self._add_binary(dist, filename)
+            elif name.endswith(".dsc"):
+                published += self._add_source(dist, filename, directory)
+        return published
+
+    def _add_architecture(self, dist, arch):
+        if arch == "all":
+            return
+        cur = self.db.execute("INSERT OR IGNORE INTO architectures"
+                              " VALUES (?, ?)", (dist, arch))
+        if cur.rowcount:
+            # A new architecture gets all arch independent packages
+            self.dirty_dists.add(dist)
+
+    def _add_binary(self, dist, filename):
+        path = os.path.join(self.root, filename)
+        control = parse_control(subprocess.check_output(["dpkg-deb", "-f",
+                                                         path]))
+        size, digests = file_hashes(path)
+        control["Filename"] = filename
+        control["Size"] = str(size)
+        for (field, _), digest in zip(HASHES, digests):
+            control[field if field != "MD5Sum" else "MD5sum"] = digest
+        arch = control["Architecture"]
+        key = (dist, self.component, arch, control["Package"],
+               control["Version"])
+        stanza = format_control(control)
+        if not self._insert("binaries", key + (filename, stanza)):
+            return 0
+        self._add_architecture(dist, arch)
+        if arch == "all":
+            archs = self.get_architectures(dist)
+        else:
+            archs = [arch]
+        for a in archs:
+            self._append(self.binary_index(dist, a), stanza)
+        return 1
+
+    def _add_source(self, dist, filename, directory):
+        path = os.path.join(self.root, filename)
+        with open(path) as f:
+            dsc = parse_control(f.read())
+        size, digests = file_hashes(path)
+        name = os.path.basename(filename)
+        control = OrderedDict([("Package", dsc.pop("Source"))])
+        control.update(dsc)
+        for field, digest in zip(("Files", "Checksums-Sha1",
+                                  "Checksums-Sha256"), digests):
+            if field in control or field == "Files":
+                control[field] = control.get(field, "") +\
+                    "\n %s %d %s" % (digest, size, name)
+        control["Directory"] = directory
+        files = "\n".join(line.split()[-1] for line in
+                          control["Files"].splitlines() if line.strip())
+        key = (dist, self.component, control["Package"], control["Version"])
+        stanza = format_control(control)
+        if not self._insert("sources", key + (directory, files, stanza)):
+            return 0
+        self._append(self.source_index(dist), stanza)
+        return 1
+
+    def _insert(self, table, row):
+        placeholders = ", ".join("?" * len(row))
+        cur = self.db.execute("INSERT OR IGNORE INTO %s VALUES (%s)"
+                              % (table, placeholders), row)
+        return cur.rowcount == 1
+
+    def _append(self, index, stanza):
+        self.pending.setdefault(index, []).append(stanza)
+        self.dirty_dists.add(index.split(os.sep)[1])
+
+    def get_architectures(self, dist):
+        cur = self.db.execute("SELECT arch FROM architectures WHERE dist = ?"
+                              " ORDER BY arch", (dist,))
+        return [row[0] for row in cur]
+
+    def binary_index(self, dist, arch):
+        return os.path.join("dists", dist, self.component, "binary-" + arch,
+                            "Packages")
+
+    def source_index(self, dist):
+        return os.path.join("dists", dist, self.component, "source",
+                            "Sources")
+
+    def write_indices(self):
+        """Append the new entries to the indices and update Release files.
+
+        The database is committed after the indices have been written.
+
+        """
+        if not self.dirty_dists:
+            self.db.commit()
+            return
+        self._write_journal(self.dirty_dists)
+        rebuilt = set()
+        for dist in sorted(self.dirty_dists):
+            for arch in self.get_architectures(dist):
+                index = self.binary_index(dist, arch)
+                if not os.path.exists(os.path.join(self.root, index)):
+                    # New architecture, which needs all arch 'all' packages
+                    self.rebuild_binary_index(dist, arch)
+                    rebuilt.add(index)
+        for index, stanzas in self.pending.items():
+            if index in rebuilt:
+                continue
+            path = os.path.join(self.root, index)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            data = "".join(stanzas)
+            with open(path, "a") as f:
+                f.write(data)
+            # Concatenated gzip members form a valid gzip file
+            with gzip.open(path + ".gz", "ab") as f:
+                f.write(data)
+        self.pending.clear()
+        for dist in sorted(self.dirty_dists):
+            self.write_release(dist)
+        self.dirty_dists.clear()
+        self.db.commit()
+        os.unlink(self.journal)
+
+    def rebuild_binary_index(self, dist, arch):
+        cur = self.db.execute("SELECT stanza FROM binaries WHERE dist = ? AND"
+                              " component = ? AND arch IN (?, 'all')"
+                              " ORDER BY package, version",
+                              (dist, self.component, arch))
+        self._write_index(self.binary_index(dist, arch),
+                          "".join(row[0] for row in cur))
+
+    def rebuild_source_index(self, dist):
+        cur = self.db.execute("SELECT stanza FROM sources WHERE dist = ? AND"
+                              " component = ? ORDER BY package, version",
+                              (dist, self.component))
+        self._write_index(self.source_index(dist),
+                          "".join(row[0] for row in cur))
+
+    def remove_files(self, filenames):
+        """Remove pool files from the index database and rebuild indices.
+
+        'filenames' are paths relative to the repository root. Only the
+        indices of the distributions that referenced them are rebuilt.
+
+        """
+        filenames = set(filenames)
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS removed"
+                        " (filename TEXT PRIMARY KEY, directory TEXT)")
+        self.db.execute("DELETE FROM removed")
+        self.db.executemany("INSERT INTO removed VALUES (?, ?)",
+                            [(f, os.path.dirname(f)) for f in filenames])
+        cur = self.db.execute("SELECT DISTINCT dist FROM binaries WHERE"
+                              " filename IN (SELECT filename FROM removed)")
+        dists = set(row[0] for row in cur)
+        self.db.execute("DELETE FROM binaries WHERE filename IN"
+                        " (SELECT filename FROM removed)")
+        # Only sources in the directories of the removed files can refer
+        # to them
+        cur = self.db.execute("SELECT dist, package, version, directory,"
+                              " files FROM sources WHERE directory IN"
+                              " (SELECT directory FROM removed)")
+        removed_sources = []
+        for dist, package, version, directory, files in cur.fetchall():
+            if not filenames.isdisjoint(os.path.join(directory, name)
+                                        for name in files.split("\n")):
+                removed_sources.append((dist, package, version))
+                dists.add(dist)
+        self.db.executemany("DELETE FROM sources WHERE dist = ? AND"
+                            " package = ? AND version = ?", removed_sources)
+        self.db.execute("DELETE FROM removed")
+        if dists:
+            self._write_journal(dists)
+        self.db.commit()
+        self.rebuild_indices(dists)
+        if dists:
+            os.unlink(self.journal)
+        return dists
+
+    def _write_index(self, index, data):
+        path = os.path.join(self.root, index)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        for name, opener in ((path, open), (path + ".gz", gzip.open)):
+            with opener(name + ".new", "wb") as f:
+                f.write(data)
+            os.rename(name + ".new", name)
+
+    def write_release(self, dist):
+        dist_dir = os.path.join(self.root, "dists", dist)
+        indices = []
+        for dirpath, _, filenames in os.walk(dist_dir):
+            for name in filenames:
+                if name.startswith("Packages") or name.startswith("Sources"):
+                    path = os.path.join(dirpath, name)
+                    indices.append((os.path.relpath(path, dist_dir),
+                                    file_hashes(path)))
+        indices.sort()
+        lines = ["Suite: %s" % dist,
+                 "Codename: %s" % dist,
+                 "Date: %s" % time.strftime("%a, %d %b %Y %H:%M:%S UTC",
+                                            time.gmtime()),
+                 "Architectures: %s" % " ".join(self.get_architectures(dist)),
+                 "Components: %s" % self.component]
+        for i, (field, _) in enumerate(HASHES):
+            lines.append("%s:" % field)
+            for relpath, (size, digests) in indices:
+                lines.append(" %s %16d %s" % (digests[i], size, relpath))
+        release = os.path.join(dist_dir, "Release")
+        with open(release + ".new", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(release + ".new", release)
+
+    def close(self):
+        self.db.close()
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] build_dir...")
+    parser.add_option("-r", "--repo-dir",
+                      dest="repo_dir",
+                      help="Root directory of the APT repository")
+    parser.add_option("--component",
+                      dest="component",
+                      default="main",
+                      help="Repository component to publish to")
+    parser.add_option("-a", "--architecture",
+                      dest="architectures",
+                      action="append",
+                      default=[],
+                      help="Architecture to create indices for. Can be given"
+                           " multiple times")
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("At least one build directory is required")
+    if options.repo_dir is None:
+        parser.error("The repository directory (-r) is required")
+
+    architectures = options.architectures or\
+        [subprocess.check_output(["dpkg", "--print-architecture"]).strip()]
+    repo = AptRepository(options.repo_dir, options.component, architectures)
+    try:
+        published = 0
+        for build_dir in args:
+            published += repo.publish_build_dir(build_dir)
+        repo.write_indices()
+    except Exception as e:
+        print_red("Failed to publish packages: %s" % e)
+        raise
+    finally:
+        repo.close()
+    print_green("Published %d new packages to '%s'." % (published,
+                                                        repo.root))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
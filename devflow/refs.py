@@ -0,0 +1,249 @@
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+
+"""Helpers for reading and atomically updating git refs."""
+
+import bisect
+import tempfile
+
+from collections import OrderedDict
+from git.exc import GitCommandError
+
+
+class RefIndex(object):
+    """Index of the refs of a repository, read with a single for-each-ref.
+
+    Local branches, remote branches and tags are kept in dictionaries keyed
+    by their short names, e.g. 'develop', 'origin/develop' and '0.13'.
+
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        output = repo.git.for_each_ref("--format=%(objectname) %(refname)")
+        self.refs = {}
+        self.branches = {}
+        self.remotes = {}
+        self.tags = {}
+        for line in output.splitlines():
+            sha, ref = line.split(" ", 1)
+            self.refs[ref] = sha
+            for prefix, names in [("refs/heads/", self.branches),
+                                  ("refs/remotes/", self.remotes),
+                                  ("refs/tags/", self.tags)]:
+                if ref.startswith(prefix):
+                    names[ref[len(prefix):]] = sha
+                    break
+        self._tag_names = None
+
+    def tags_with_prefix(self, prefix):
+        """Return the names of the tags that start with 'prefix'"""
+        if self._tag_names is None:
+            self._tag_names = sorted(self.tags)
+        names = self._tag_names
+        start = bisect.bisect_left(names, prefix)
+        end = start
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        return names[start:end]
+
+
+# Ref indexes, by git directory
+_ref_indexes = {}
+
+
+def get_ref_index(repo):
+    """Return the ref index of a repository, building it if needed"""
+    index = _ref_indexes.get(repo.git_dir)
+    if index is None:
+        index = _ref_indexes[repo.git_dir] = RefIndex(repo)
+    return index
+
+
+def invalidate_ref_index(repo):
+    """Drop the ref index of a repository, after devflow has changed refs"""
+    _ref_indexes.pop(repo.git_dir, None)
+
+
+class RefTransaction(object):
+    """Journal of the refs changed by a devflow operation.
+
+    The original value of every ref that is touched is recorded. Updates are
+    queued and applied together, in a single atomic 'git update-ref --stdin'
+    transaction, by commit(). rollback() restores every touched ref to its
+    original value, again in a single transaction.
+
+    Ref values are hexshas, or None for refs that do not exist.
+
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.original = OrderedDict()
+        self.pending = OrderedDict()
+        # Values of the touched refs in the repository
+        self.current = {}
+        self._snapshot = None
+
+    def snapshot(self):
+        """Return the values of all refs, read with a single for-each-ref"""
+        if self._snapshot is None:
+            self._snapshot = dict(get_ref_index(self.repo).refs)
+        return self._snapshot
+
+    def _touch(self, ref):
+        if ref not in self.original:
+            value = self.snapshot().get(ref)
+            self.original[ref] = value
+            self.current[ref] = value
+
+    def resolve(self, ref):
+        """Return the value of a ref, including any pending update"""
+        if ref in self.pending:
+            return self.pending[ref]
+        if ref in self.current:
+            return self.current[ref]
+        return self.snapshot().get(ref)
+
+    def update(self, ref, new_sha):
+        self._touch(ref)
+        self.pending[ref] = new_sha
+
+    def delete(self, ref):
+        self.update(ref, None)
+
+    def reload(self, ref):
+        """Record that a ref has been changed outside of the transaction.
+
+        Used after the user has modified a ref, e.g. while resolving merge
+        conflicts. The original value of the ref is kept for rollback.
+
+        """
+        self._touch(ref)
+        self.pending.pop(ref, None)
+        try:
+            value = self.repo.git.rev_parse("--verify", "-q", ref)
+        except GitCommandError:
+            value = None
+        self.current[ref] = value
+        self.snapshot()[ref] = value
+        invalidate_ref_index(self.repo)
+
+    def commit(self, message="devflow", checkout=None):
+        """Apply all pending updates in a single transaction.
+
+        If 'checkout' is given, that branch is checked out as part of the
+        transaction, updating only the files that differ from HEAD.
+
+        """
+        updates = [(ref, self.current[ref], new)
+                   for ref, new in self.pending.items()
+                   if new != self.current[ref]]
+        self.pending.clear()
+        self._apply(updates, message, checkout)
+
+    def rollback(self, message="devflow: rollback"):
+        """Restore all touched refs to their original values"""
+        self.pending.clear()
+        updates = [(ref, self.current[ref], old)
+                   for ref, old in self.original.items()
+                   if old != self.current[ref]]
+        self._apply(updates, message, sync_worktree=False)
+
+    def _apply(self, updates, message, checkout=None, sync_worktree=True):
+        repo = self.repo
+        head = self._head_ref()
+        if checkout is not None:
+            checkout = "refs/heads/" + checkout
+            if checkout == head:
+                checkout = None
+        head_sha = repo.head.commit.hexsha
+        worktree_update = None
+        if checkout is not None:
+            # Switch to the new value of the branch to check out
+            new_values = dict((ref, new) for ref, _, new in updates)
+            worktree_update = (head_sha,
+                               new_values.get(checkout,
+                                              self.resolve(checkout)))
+        elif sync_worktree:
+            for ref, old, new in updates:
+                if ref == head and old and new:
+                    worktree_update = (old, new)
+        if not updates and checkout is None:
+            return
+
+        if worktree_update:
+            # Update only the files that differ
+            repo.git.read_tree("-m", "-u", *worktree_update)
+        if checkout is not None:
+            repo.git.symbolic_ref("HEAD", checkout)
+        try:
+            self._update_refs(updates, message)
+        except:
+            if checkout is not None:
+                repo.git.symbolic_ref("HEAD", head)
+            if worktree_update:
+                repo.git.read_tree("-m", "-u", *reversed(worktree_update))
+            raise
+        for ref, _, new in updates:
+            self.current[ref] = new
+            if new is None:
+                self.snapshot().pop(ref, None)
+            else:
+                self.snapshot()[ref] = new
+
+    def _update_refs(self, updates, message):
+        if not updates:
+            return
+        commands = []
+        for ref, old, new in updates:
+            if new is None:
+                commands.append("delete %s %s\n" % (ref, old))
+            elif old is None:
+                commands.append("create %s %s\n" % (ref, new))
+            else:
+                commands.append("update %s %s %s\n" % (ref, new, old))
+        stdin = tempfile.TemporaryFile()
+        try:
+            stdin.write("".join(commands).encode("utf-8"))
+            stdin.seek(0)
+            self.repo.git.update_ref("-m", message, "--stdin", istream=stdin)
+        finally:
+            stdin.close()
+            invalidate_ref_index(self.repo)
+
+    def _head_ref(self):
+        if self.repo.head.is_detached:
+            return None
+        return self.repo.head.reference.path
@@ -0,0 +1,184 @@
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+
+"""Helper script for signing the artifacts of deferred autopkg builds.
+
+When `devflow-autopkg` runs with `--defer-signing`, packages are built
+unsigned and the tags that would have been signed are recorded in a manifest
+file inside the build directory. This script signs all `.changes` and `.dsc`
+files and all recorded tags of one or more build directories in a single
+gpg-agent session.
+
+"""
+
+import os
+import sys
+import glob
+import json
+
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+
+from devflow import utils
+from devflow.utils import call, print_green, print_red
+
+MANIFEST_FILE = "devflow-unsigned"
+
+
+def record_deferred_signing(build_dir, repo_dir, tags, keyid):
+    """Record the tags of a build that must be signed later."""
+    entry = {"repo": repo_dir, "tags": tags, "keyid": keyid}
+    with open(os.path.join(build_dir, MANIFEST_FILE), "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def read_manifest(build_dir):
+    path = os.path.join(build_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def get_signing_groups(build_dir):
+    """Group the files of a build directory that can be signed in parallel.
+
+    debsign signs a '.changes' file together with the '.dsc' file it refers
+    to. Multiple '.changes' files may refer to the same '.dsc' (e.g. a source
+    and a binary upload), so they are placed in the same group and signed
+    sequentially. '.dsc' files that are not referred to by any '.changes'
+    file form groups of their own.
+
+    """
+    groups = {}
+    referenced = set()
+    for changes in sorted(glob.glob(os.path.join(build_dir, "*.changes"))):
+        with open(changes) as f:
+            dscs = set(word for line in f for word in line.split()
+                       if word.endswith(".dsc"))
+        referenced.update(dscs)
+        key = min(dscs) if dscs else changes
+        groups.setdefault(key, []).append(changes)
+    for dsc in sorted(glob.glob(os.path.join(build_dir, "*.dsc"))):
+        if os.path.basename(dsc) not in referenced:
+            groups[dsc] = [dsc]
+    return [groups[key] for key in sorted(groups)]
+
+
+def sign_files(files, keyid):
+    keyopt = " -k'%s'" % keyid if keyid else ""
+    for path in files:
+        call("debsign --no-re-sign%s '%s'" % (keyopt, path))
+        print_green("Signed '%s'" % path)
+
+
+def sign_tags(repo_dir, tags, keyid):
+    """Replace the annotated tags of a repository with signed ones."""
+    repo = utils.get_repository(repo_dir)
+    sign_opt = ["-u", keyid] if keyid else ["-s"]
+    for tag in tags:
+        message = repo.git.for_each_ref("--format=%(contents)",
+                                        "refs/tags/" + tag)
+        args = ["-f"] + sign_opt + ["-m", message, tag, tag + "^{}"]
+        repo.git.tag(*args)
+        print_green("Signed tag '%s' in '%s'" % (tag, repo_dir))
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] build_dir...")
+    parser.add_option("--key-id",
+                      dest="keyid",
+                      help="Use this keyid for gpg signing, instead of the"
+                           " one recorded by devflow-autopkg")
+    parser.add_option("-j", "--jobs",
+                      dest="jobs",
+                      type="int",
+                      default=4,
+                      help="Number of signing jobs to run in parallel")
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("At least one build directory is required")
+
+    file_jobs = []
+    tag_jobs = {}
+    for build_dir in args:
+        build_dir = os.path.abspath(build_dir)
+        entries = read_manifest(build_dir)
+        keyid = options.keyid
+        if keyid is None and entries:
+            keyid = entries[-1]["keyid"]
+        file_jobs.extend((group, keyid)
+                         for group in get_signing_groups(build_dir))
+        for entry in entries:
+            if entry["repo"] and entry["tags"]:
+                repo_tags = tag_jobs.setdefault(entry["repo"], ([], set()))
+                repo_tags[0].extend(entry["tags"])
+                repo_tags[1].add(options.keyid or entry["keyid"])
+
+    if not file_jobs and not tag_jobs:
+        print_red("Nothing to sign.")
+        return
+
+    # Make sure that a single gpg-agent serves all signatures and sign the
+    # first group alone, so that the passphrase is asked only once.
+    call("gpg-connect-agent /bye > /dev/null")
+    jobs = [partial(sign_files, *job) for job in file_jobs]
+    # Tags of the same repository are signed sequentially, since git locks
+    # the packed refs while creating them.
+    for repo_dir, (tags, keyids) in sorted(tag_jobs.items()):
+        if len(keyids) > 1:
+            raise ValueError("Tags of repository '%s' are recorded with"
+                             " different keys: %s" % (repo_dir, list(keyids)))
+        jobs.append(partial(sign_tags, repo_dir, tags, keyids.pop()))
+
+    jobs[0]()
+    pool = ThreadPool(max(options.jobs, 1))
+    try:
+        for _ in pool.imap_unordered(lambda job: job(), jobs[1:]):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+
+    for build_dir in args:
+        manifest = os.path.join(build_dir, MANIFEST_FILE)
+        if os.path.exists(manifest):
+            os.unlink(manifest)
+    print_green("Signed %d file groups and the tags of %d repositories."
+                % (len(file_jobs), len(tag_jobs)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
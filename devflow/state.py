@@ -0,0 +1,235 @@
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+
+"""Version state of the working tree, kept up to date by git hooks.
+
+'devflow-flow init --hooks' installs git hooks that run after every commit,
+checkout, merge and rewrite, and write the version information of HEAD to
+'<git dir>/devflow/state.json'. Version queries then read that file,
+without running git, as long as the checked out branch, HEAD and the
+version file have not changed since it was written.
+
+The debian version depends on the debian tags, which the hooks do not
+track, so it is not kept in the state. It is computed from the tag index
+when it is needed.
+
+"""
+
+import os
+import sys
+import json
+import tempfile
+
+from devflow import BASE_VERSION_FILE
+from devflow import utils
+
+
+HOOKS = ["post-commit", "post-checkout", "post-merge", "post-rewrite"]
+_HOOK_MARKER = "# devflow: update the version state"
+_HOOK_TEMPLATE = """#!/bin/sh
+%(marker)s
+"%(python)s" -m devflow.state >/dev/null 2>&1 || true
+"""
+
+
+def state_path(git_dir):
+    return os.path.join(git_dir, "devflow", "state.json")
+
+
+def install_hooks(repo):
+    """Install the hooks that update the version state.
+
+    Existing hooks that were not installed by devflow are left alone.
+    Returns the names of the installed hooks.
+
+    """
+    hooks_dir = os.path.join(repo.working_dir,
+                             repo.git.rev_parse("--git-path", "hooks"))
+    if not os.path.isdir(hooks_dir):
+        os.makedirs(hooks_dir)
+    content = _HOOK_TEMPLATE % {"marker": _HOOK_MARKER,
+                                "python": sys.executable}
+    installed = []
+    for hook in HOOKS:
+        path = os.path.join(hooks_dir, hook)
+        if os.path.exists(path):
+            with open(path) as f:
+                if _HOOK_MARKER not in f.read():
+                    print "Hook '%s' already exists, not replacing it" % path
+                    continue
+        with open(path, "w") as f:
+            f.write(content)
+        os.chmod(path, 0755)
+        installed.append(hook)
+    return installed
+
+
+def update_state(repo=None):
+    """Write the version state of HEAD
+
+    The state is removed if the version of HEAD can not be computed, e.g.
+    on a detached HEAD. Returns the new state, or None.
+
+    """
+    # Imported here, as versioning reads the state
+    from devflow import versioning
+    if repo is None:
+        repo = utils.get_repository()
+    path = state_path(repo.git_dir)
+    # The state records the default build mode of the branch
+    saved_mode = os.environ.pop("DEVFLOW_BUILD_MODE", None)
+    try:
+        v = utils.get_vcs_info()
+        mode = utils.get_build_mode(v.branch)
+        env = versioning.version_env(v, mode)
+        del env["DEVFLOW_DEBIAN_VERSION"]
+        ref, head = _read_head(repo.git_dir)
+        state = {"head": head,
+                 "ref": ref,
+                 "branch": v.branch,
+                 "revno": v.revno,
+                 "mode": mode,
+                 "toplevel": v.toplevel,
+                 "version_file": _stat(v.toplevel),
+                 "env": env}
+    except Exception:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+    finally:
+        if saved_mode is not None:
+            os.environ["DEVFLOW_BUILD_MODE"] = saved_mode
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(prefix="state-", dir=directory)
+    with os.fdopen(fd, "w") as f:
+        json.dump(state, f)
+    os.rename(tmp_path, path)
+    return state
+
+
+def refresh_state(repo):
+    """Update the version state, if it is maintained"""
+    if os.path.exists(state_path(repo.git_dir)):
+        update_state(repo)
+
+
+def read_state(path=None):
+    """Return the version state of the working tree, or None
+
+    Only the state file, HEAD and the version file are read. The state is
+    returned only if it describes the current branch, HEAD, version file
+    and build mode.
+
+    """
+    git_dir = _find_git_dir(path or os.getcwd())
+    if git_dir is None:
+        return None
+    try:
+        with open(state_path(git_dir)) as f:
+            state = json.load(f)
+        ref, head = _read_head(git_dir)
+    except (IOError, OSError, ValueError):
+        return None
+    # A renamed branch keeps its commit, but not its version
+    if head != state.get("head") or ref != state.get("ref"):
+        return None
+    mode = os.environ.get("DEVFLOW_BUILD_MODE")
+    if mode is not None and mode != state.get("mode"):
+        return None
+    try:
+        if _stat(state["toplevel"]) != state["version_file"]:
+            return None
+    except (KeyError, OSError):
+        return None
+    return state
+
+
+def _stat(toplevel):
+    st = os.stat(os.path.join(toplevel, BASE_VERSION_FILE))
+    return [st.st_mtime, st.st_size]
+
+
+def _find_git_dir(path):
+    if "GIT_DIR" in os.environ:
+        return None
+    while True:
+        dotgit = os.path.join(path, ".git")
+        if os.path.isdir(dotgit):
+            return dotgit
+        if os.path.isfile(dotgit):
+            # A linked worktree or submodule
+            with open(dotgit) as f:
+                content = f.read().strip()
+            if not content.startswith("gitdir: "):
+                return None
+            return os.path.join(path, content[len("gitdir: "):])
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def _read_head(git_dir):
+    """Return the symbolic ref and the sha of HEAD, reading the ref files
+    directly. The ref is None for a detached HEAD."""
+    with open(os.path.join(git_dir, "HEAD")) as f:
+        head = f.read().strip()
+    if not head.startswith("ref: "):
+        return None, head
+    ref = head[len("ref: "):]
+    # Refs of linked worktrees are kept in the common git directory
+    common_dir = git_dir
+    try:
+        with open(os.path.join(git_dir, "commondir")) as f:
+            common_dir = os.path.join(git_dir, f.read().strip())
+    except IOError:
+        pass
+    try:
+        with open(os.path.join(common_dir, ref)) as f:
+            return ref, f.read().strip()
+    except IOError:
+        pass
+    with open(os.path.join(common_dir, "packed-refs")) as f:
+        for line in f:
+            if line.rstrip("\n").endswith(" " + ref):
+                return ref, line.split(" ", 1)[0]
+    return ref, None
+
+
+if __name__ == "__main__":
+    update_state()
@@ -0,0 +1,230 @@
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+
+
+
+"""Persistent index of the versions of the tags of a repository."""
+
+import os
+import re
+import json
+import bisect
+import tempfile
+
+from devflow import utils
+from devflow.refs import get_ref_index
+from devflow.versioning import Version
+
+
+# Debian tags are 'debian/<upstream>-<revision><codename>', without '~'
+_debian_tag_re = re.compile(r"^debian/(?P<upstream>.+)-(?P<revision>[0-9]+)"
+                            r"(?P<codename>[^0-9-]*)$")
+
+
+class TagIndex(object):
+    """Index of the versions of the tags of a repository.
+
+    Version tags, e.g. '0.14rc2_120_abc1234', the tags of release and hotfix
+    flows, e.g. 'release-0.14', and debian tags, e.g. 'debian/0.14-1wheezy',
+    are parsed once. The index is kept in '<git dir>/devflow/tags.json' and
+    is updated incrementally: only the tags that have been added or moved
+    since the last update are parsed.
+
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = os.path.join(repo.git_dir, "devflow", "tags.json")
+        self.tags = {}
+        self.versions = {}
+        self.debian_tags = {}
+        self._revisions = {}
+        self._sorted = None
+        self._keys = []
+        self._finals = []
+        # The ref index that the index is up to date with
+        self._ref_index = None
+        self._load()
+        self.update()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        self.tags = data["tags"]
+        for tag, (numbers, next, rc, revno, revid) in \
+                data["versions"].items():
+            self.versions[tag] = Version(numbers, next, rc, revno, revid)
+        for tag, entry in data["debian"].items():
+            self._add_debian(tag, *entry)
+
+    def _save(self):
+        """Store the index, if the git directory is writable"""
+        data = {"tags": self.tags,
+                "versions": dict((tag, [v.numbers, v.next, v.rc, v.revno,
+                                        v.revid])
+                                 for tag, v in self.versions.items()),
+                "debian": self.debian_tags}
+        directory = os.path.dirname(self.path)
+        tmp = None
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            # e.g. a read-only checkout, where the index is kept in memory
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def update(self):
+        """Bring the index up to date with the tags of the repository"""
+        ref_index = get_ref_index(self.repo)
+        if ref_index is self._ref_index:
+            return
+        self._ref_index = ref_index
+        current = ref_index.tags
+        changed = [t for t, sha in self.tags.items() if current.get(t) != sha]
+        added = [t for t, sha in current.items() if self.tags.get(t) != sha]
+        if not changed and not added:
+            return
+        for tag in changed:
+            self._remove(tag)
+        for tag in added:
+            self._add(tag, current[tag])
+        self._sorted = None
+        self._save()
+
+    def _add(self, tag, sha):
+        self.tags[tag] = sha
+        if tag.startswith("debian/"):
+            m = _debian_tag_re.match(tag)
+            if m is not None:
+                self._add_debian(tag, m.group("upstream"),
+                                 int(m.group("revision")),
+                                 m.group("codename"))
+            return
+        if tag.startswith("upstream/"):
+            return
+        name = tag
+        for prefix in ["release-", "hotfix-"]:
+            if tag.startswith(prefix):
+                name = tag[len(prefix):]
+        try:
+            self.versions[tag] = Version.parse(name)
+        except ValueError:
+            pass
+
+    def _add_debian(self, tag, upstream, revision, codename):
+        self.debian_tags[tag] = (upstream, revision, codename)
+        self._revisions.setdefault((upstream, codename), set()).add(revision)
+
+    def _remove(self, tag):
+        del self.tags[tag]
+        self.versions.pop(tag, None)
+        entry = self.debian_tags.pop(tag, None)
+        if entry is not None:
+            upstream, revision, codename = entry
+            self._revisions[(upstream, codename)].discard(revision)
+
+    def _sorted_versions(self):
+        """Return the (Version, tag) pairs, sorted by version"""
+        if self._sorted is None:
+            self._sorted = sorted(((v, tag) for tag, v in
+                                   self.versions.items()),
+                                  key=lambda pair: pair[0].debian_key)
+            self._keys = [v.debian_key for v, _ in self._sorted]
+            self._finals = [v for v, _ in self._sorted
+                            if not v.next and v.rc is None and
+                            v.revno is None]
+        return self._sorted
+
+    def latest_release(self):
+        """Return the latest released Version, or None"""
+        self._sorted_versions()
+        return self._finals[-1] if self._finals else None
+
+    def latest_hotfix(self, major, minor):
+        """Return the latest hotfix Version of a minor version, or None"""
+        self._sorted_versions()
+        for v in reversed(self._finals):
+            if v.numbers[:2] == (major, minor) and len(v.numbers) > 2:
+                return v
+            if v.numbers[:2] < (major, minor):
+                break
+        return None
+
+    def snapshots_between(self, low, high):
+        """Return the (Version, tag) pairs of the snapshots between two
+        versions, inclusive, sorted by version"""
+        versions = self._sorted_versions()
+        start = bisect.bisect_left(self._keys, low.debian_key)
+        end = bisect.bisect_right(self._keys, high.debian_key)
+        return [(v, tag) for v, tag in versions[start:end]
+                if v.revno is not None]
+
+    def debian_tag(self, debian_version):
+        """Return the tag of a debian version, or None if it is not tagged"""
+        tag = "debian/" + utils.version_to_tag(debian_version)
+        return tag if tag in self.debian_tags else None
+
+    def next_debian_revision(self, upstream_version, codename):
+        """Return the first debian revision of a version that is not tagged
+
+        'upstream_version' is the upstream part of the debian version.
+
+        """
+        revisions = self._revisions.get(
+            (utils.version_to_tag(upstream_version), codename), ())
+        revision = 1
+        while revision in revisions:
+            revision += 1
+        return revision
+
+
+# Tag indexes, by git directory
+_tag_indexes = {}
+
+
+def get_tag_index(repo):
+    """Return the up to date tag index of a repository"""
+    index = _tag_indexes.get(repo.git_dir)
+    if index is None:
+        index = _tag_indexes[repo.git_dir] = TagIndex(repo)
+    else:
+        index.update()
+    return index
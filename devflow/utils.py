@@ -32,13 +32,54 @@
 # or implied, of GRNET S.A.
 
 import os
+import sys
 import git
 import sh
 import re
-from collections import namedtuple
+import shutil
+import tempfile
+import subprocess
+from cStringIO import StringIO
+from collections import namedtuple, Counter
 from configobj import ConfigObj
+from gitdb import IStream
+from git.refs.log import RefLogEntry
 
-from devflow import BRANCH_TYPES
+from devflow import BRANCH_TYPES, branch_type
+from devflow.branches import BranchClassifier
+from devflow.cache import get_version_cache
+from devflow.refs import get_ref_index, invalidate_ref_index
+
+if sys.stdout.isatty():
+    try:
+        import colors
+        use_colors = True
+    except AttributeError:
+        use_colors = False
+else:
+    use_colors = False
+
+
+if use_colors:
+    red = colors.red
+    green = colors.green
+else:
+    red = lambda x: x
+    green = lambda x: x
+
+print_red = lambda x: sys.stdout.write(red(x) + "\n")
+print_green = lambda x: sys.stdout.write(green(x) + "\n")
+
+
+def call(cmd, env=None):
+    """Run a shell command, optionally with a different environment"""
+    rc = subprocess.call(cmd, shell=True, env=env)
+    if rc:
+        raise RuntimeError("Command '%s' failed!" % cmd)
+
+
+vcs_info = namedtuple("vcs_info", ["branch", "revid", "revno", "toplevel",
+                                   "name", "email"])
 
 
 def get_repository(path=None):
@@ -78,7 +119,7 @@ def get_vcs_info():
     repo = get_repository()
     branch = repo.head.reference
     revid = get_commit_id(branch.commit, branch)
-    revno = len(list(repo.iter_commits()))
+    revno = get_commit_count(repo, branch.commit.hexsha)
     toplevel = repo.working_dir
     config = repo.config_reader()
     try:
@@ -88,11 +129,27 @@ def get_vcs_info():
         raise ValueError("Can not read name/email from .gitconfig"
                          " file.: %s" % e)
 
-    info = namedtuple("vcs_info", ["branch", "revid", "revno",
-                                   "toplevel", "name", "email"])
+    return vcs_info(branch=branch.name, revid=revid, revno=revno,
+                    toplevel=toplevel, name=name, email=email)
+
+
+_sha_re = re.compile(r"^\^?[0-9a-f]{40}$")
+
 
-    return info(branch=branch.name, revid=revid, revno=revno,
-                toplevel=toplevel, name=name, email=email)
+def get_commit_count(repo, *revs):
+    """Return the number of commits reachable from the given revisions.
+
+    Counts of commit shas are kept in the shared version cache, if enabled.
+
+    """
+    cache = get_version_cache()
+    if cache is None or not all(_sha_re.match(rev) for rev in revs):
+        return int(repo.git.rev_list("--count", *revs))
+    count = cache.get("count", *revs)
+    if count is None:
+        count = int(repo.git.rev_list("--count", *revs))
+        cache.put("count", count, *revs)
+    return count
 
 
 def get_commit_id(commit, current_branch):
@@ -102,76 +159,288 @@ def get_commit_id(commit, current_branch):
     debian branch we return a compination of the parents commits.
 
     """
-    def short_id(commit):
-        return commit.hexsha[0:7]
+    return format_commit_id(commit.hexsha,
+                            [p.hexsha for p in commit.parents],
+                            current_branch.name)
 
-    parents = commit.parents
-    cur_br_name = current_branch.name
-    if len(parents) == 1:
-        return short_id(commit)
+
+def format_commit_id(hexsha, parents, cur_br_name):
+    """Return the commit ID of a commit given its parents' hexshas"""
+    def short_id(hexsha):
+        return hexsha[0:7]
+
+    if len(parents) <= 1:
+        return short_id(hexsha)
     elif len(parents) == 2:
         if cur_br_name.startswith("debian-") or cur_br_name == "debian":
             pr1, pr2 = parents
             return short_id(pr1) + "_" + short_id(pr2)
         else:
-            return short_id(commit)
+            return short_id(hexsha)
     else:
-        raise RuntimeError("Commit %s has more than 2 parents!" % commit)
+        raise RuntimeError("Commit %s has more than 2 parents!" % hexsha)
 
 
 def get_debian_branch(branch):
-    """Find the corresponding debian- branch"""
-    distribution = get_distribution_codename()
+    """Find the corresponding debian- branch
+
+    The debian branch is created if it does not exist yet.
+
+    """
     repo = get_repository()
+    deb_branch, start_point = find_debian_branch(branch, repo)
+    if start_point is not None:
+        repo.git.branch(deb_branch, start_point)
+        invalidate_ref_index(repo)
+        print "Created branch '%s' from '%s'" % (deb_branch, start_point)
+    return deb_branch
+
+
+def find_debian_branch(branch, repo=None):
+    """Find the corresponding debian- branch, without creating any branch.
+
+    Returns a tuple with the name of the debian branch and the ref that the
+    branch must be created from, or None if the branch already exists
+    locally.
+
+    """
+    distribution = get_distribution_codename()
+    if repo is None:
+        repo = get_repository()
     if branch == "master":
         deb_branch = "debian-" + distribution
     else:
         deb_branch = "-".join(["debian", branch, distribution])
     # Check if debian-branch exists (local or origin)
-    if _get_branch(deb_branch):
-        return deb_branch
+    ref = _find_branch(deb_branch, repo)
+    if ref:
+        return deb_branch, None if ref == deb_branch else ref
     # Check without distribution
     deb_branch = re.sub("-" + distribution + "$", "", deb_branch)
-    if _get_branch(deb_branch):
-        return deb_branch
+    ref = _find_branch(deb_branch, repo)
+    if ref:
+        return deb_branch, None if ref == deb_branch else ref
     branch_type = BRANCH_TYPES[get_branch_type(branch)]
-    # If not try the default debian branch with distribution
-    default_branch = branch_type.debian_branch + "-" + distribution
-    if _get_branch(default_branch):
-        repo.git.branch(deb_branch, default_branch)
-        print "Created branch '%s' from '%s'" % (deb_branch, default_branch)
-        return deb_branch
-    # And without distribution
-    default_branch = branch_type.debian_branch
-    if _get_branch(default_branch):
-        repo.git.branch(deb_branch, default_branch)
-        print "Created branch '%s' from '%s'" % (deb_branch, default_branch)
-        return deb_branch
-    # If not try the debian branch
-    repo.git.branch(deb_branch, default_branch)
-    print "Created branch '%s' from 'debian'" % deb_branch
-    return "debian"
-
-
-def _get_branch(branch):
-    repo = get_repository()
-    if branch in repo.branches:
+    # If not try the default debian branch with distribution, and without
+    for default_branch in [branch_type.debian_branch + "-" + distribution,
+                           branch_type.debian_branch]:
+        ref = _find_branch(default_branch, repo)
+        if ref:
+            return deb_branch, ref
+    raise RuntimeError("Can not find a debian branch for branch '%s'"
+                       % branch)
+
+
+def _find_branch(branch, repo):
+    """Return the local or the origin ref of a branch, or None."""
+    index = get_ref_index(repo)
+    if branch in index.branches:
         return branch
     origin_branch = "origin/" + branch
-    if origin_branch in repo.refs:
-        print "Creating branch '%s' to track '%s'" % (branch, origin_branch)
-        repo.git.branch(branch, origin_branch)
+    if origin_branch in index.remotes:
+        return origin_branch
+    return None
+
+
+def _get_branch(branch, repo=None):
+    if repo is None:
+        repo = get_repository()
+    ref = _find_branch(branch, repo)
+    if ref is not None and ref != branch:
+        print "Creating branch '%s' to track '%s'" % (branch, ref)
+        repo.git.branch(branch, ref)
+        invalidate_ref_index(repo)
         return branch
+    return ref
+
+
+def read_file_at(repo, rev, path, default=None):
+    """Return the contents of a file in a commit, without checking it out.
+
+    If the file does not exist, 'default' is returned if given, otherwise
+    KeyError is raised.
+
+    """
+    try:
+        blob = repo.commit(rev).tree / path
+    except KeyError:
+        if default is None:
+            raise
+        return default
+    return blob.data_stream.read()
+
+
+def copy_file_at(repo, rev, path, dest):
+    """Stream the contents of a file in a commit to a file object.
+
+    Returns False if the file does not exist.
+
+    """
+    try:
+        blob = repo.commit(rev).tree / path
+    except KeyError:
+        return False
+    shutil.copyfileobj(blob.data_stream, dest)
+    return True
+
+
+def write_commit_subjects(repo, dest, rev_range, prefix=""):
+    """Write the subjects of the commits in a range to a file object.
+
+    The subjects are streamed from a single 'git log' walk, one per line,
+    newest first.
+
+    """
+    proc = repo.git.log("--format=" + prefix + "%s", rev_range,
+                        as_process=True)
+    for line in proc.stdout:
+        dest.write(line)
+    proc.wait()
+
+
+def walk_history(repo, tips):
+    """Walk the history of several commits with a single 'git rev-list'.
+
+    Every commit is marked with the set of 'tips' it is reachable from,
+    encoded as a bitmask with bit i standing for tips[i]. Returns a tuple
+    with a Counter that maps each bitmask to the number of commits that
+    have it, and a dict with the parents of every tip.
+
+    """
+    masks = {}
+    for i, sha in enumerate(tips):
+        masks[sha] = masks.get(sha, 0) | (1 << i)
+    tip_shas = set(tips)
+    counts = Counter()
+    parents = {}
+    if not tips:
+        return counts, parents
+    # In topological order all children of a commit come before it, so its
+    # mask is complete when it is reached
+    proc = repo.git.rev_list("--parents", "--topo-order", *tip_shas,
+                             as_process=True)
+    for line in proc.stdout:
+        shas = line.split()
+        mask = masks.pop(shas[0], 0)
+        counts[mask] += 1
+        if shas[0] in tip_shas:
+            parents[shas[0]] = shas[1:]
+        for parent in shas[1:]:
+            masks[parent] = masks.get(parent, 0) | mask
+    proc.wait()
+    return counts, parents
+
+
+def count_commits(counts, include, exclude=0):
+    """Count the commits of a walk_history() walk that are reachable from
+    any of the 'include' tips but from none of the 'exclude' tips."""
+    return sum(n for mask, n in counts.iteritems()
+               if mask & include and not mask & exclude)
+
+
+def read_reflog_tail(repo, ref="HEAD", count=1, chunk_size=4096):
+    """Return the last 'count' entries of the reflog of a ref.
+
+    The reflog is read backwards from its end, so the cost does not depend
+    on the size of the reflog. Entries are returned oldest first.
+
+    """
+    path = os.path.join(repo.git_dir, "logs", ref)
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return []
+    with f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = ""
+        # One more newline than lines, as the log ends with a newline
+        while position > 0 and data.count("\n") <= count:
+            size = min(chunk_size, position)
+            position -= size
+            f.seek(position)
+            data = f.read(size) + data
+    lines = [l for l in data.split("\n") if l]
+    if position > 0:
+        # The first line may be incomplete
+        lines = lines[1:]
+    return [RefLogEntry.from_line(l) for l in lines[-count:]]
+
+
+def commit_file(repo, branch, path, content, message, transaction=None):
+    """Commit new contents of a file to a branch, without checking it out.
+
+    The blob is written to the object database, the new tree is built from
+    the tip of the branch in a temporary index and the branch is advanced to
+    the new commit. If a RefTransaction is given, the update of the branch
+    is queued to it instead. 'content' is either a string or a file object.
+    Returns the hexsha of the new commit.
+
+    """
+    ref = "refs/heads/" + branch
+    if transaction is not None:
+        old_sha = transaction.resolve(ref)
     else:
-        return None
+        old_sha = repo.commit(ref).hexsha
+    new_sha = create_file_commit(repo, old_sha, path, content, message)
+    if transaction is not None:
+        transaction.update(ref, new_sha)
+    else:
+        update_branch(repo, branch, new_sha, old_sha, message)
+    return new_sha
 
 
-def get_build_mode():
+def create_file_commit(repo, parent, path, content, message):
+    """Create a commit on top of 'parent' that changes a single file."""
+    if isinstance(content, basestring):
+        size, stream = len(content), StringIO(content)
+    else:
+        # Store the blob from the file in chunks
+        content.seek(0, os.SEEK_END)
+        size = content.tell()
+        content.seek(0)
+        stream = content
+    istream = repo.odb.store(IStream("blob", size, stream))
+    try:
+        mode = "%o" % (repo.commit(parent).tree / path).mode
+    except KeyError:
+        mode = "100644"
+    fd, index_file = tempfile.mkstemp(prefix="devflow-index-",
+                                      dir=repo.git_dir)
+    os.close(fd)
+    try:
+        with repo.git.custom_environment(GIT_INDEX_FILE=index_file):
+            repo.git.read_tree(parent)
+            repo.git.update_index("--add", "--cacheinfo",
+                                  "%s,%s,%s" % (mode, istream.hexsha, path))
+            tree = repo.git.write_tree()
+    finally:
+        os.unlink(index_file)
+    return repo.git.commit_tree(tree, "-p", parent, "-m", message)
+
+
+def update_branch(repo, branch, new_sha, old_sha, message):
+    """Point a branch to a new commit.
+
+    If the branch is checked out, only the files that differ between the
+    two commits are updated in the index and the working tree.
+
+    """
+    if not repo.head.is_detached and repo.head.reference.name == branch:
+        repo.git.read_tree("-m", "-u", old_sha, new_sha)
+    repo.git.update_ref("-m", message, "refs/heads/" + branch, new_sha,
+                        old_sha)
+    invalidate_ref_index(repo)
+
+
+def get_build_mode(branch=None):
     """Determine the build mode"""
     # Get it from environment if exists
     mode = os.environ.get("DEVFLOW_BUILD_MODE", None)
     if mode is None:
-        branch = get_branch_type(get_vcs_info().branch)
+        if branch is None:
+            branch = get_vcs_info().branch
+        branch = get_branch_type(branch)
         try:
             br_type = BRANCH_TYPES[get_branch_type(branch)]
         except KeyError:
@@ -182,31 +451,74 @@ def get_build_mode():
     return mode
 
 
+_classifier = None
+
+
+def get_classifier():
+    """Return the branch classifier, creating it on first use.
+
+    The branch types of the 'branch_types' section of devflow.conf are
+    registered before the classifier is created.
+
+    """
+    global _classifier
+    if _classifier is None:
+        load_branch_types()
+        _classifier = BranchClassifier(BRANCH_TYPES,
+                                       get_distribution_codename())
+    return _classifier
+
+
+def classify_branch(branch_name):
+    """Return the BranchInfo of a branch name"""
+    return get_classifier().classify(branch_name)
+
+
+def load_branch_types(repo=None):
+    """Register the branch types defined in devflow.conf.
+
+    Each subsection of the 'branch_types' section defines a branch type,
+    with the fields of devflow.branch_type, e.g.:
+
+    [ branch_types ]
+      [[ bugfix ]]
+        builds_snapshot = True
+        builds_release = False
+        versioned = False
+        allowed_version_re = "^[0-9]+\.[0-9]+(\.[0-9]+)*next$"
+        debian_branch = debian-develop
+
+    The configuration is read from the working tree, or from HEAD in bare
+    repositories.
+
+    """
+    try:
+        if repo is None:
+            repo = get_repository()
+        if repo.bare:
+            content = read_file_at(repo, "HEAD", "devflow.conf", default="")
+            config = ConfigObj(content.splitlines())
+        else:
+            config = ConfigObj(os.path.join(repo.working_dir, "devflow.conf"))
+    except (RuntimeError, ValueError):
+        return
+    for name, section in config.get("branch_types", {}).items():
+        BRANCH_TYPES[name] = branch_type(
+            builds_snapshot=section.as_bool("builds_snapshot"),
+            builds_release=section.as_bool("builds_release"),
+            versioned=section.as_bool("versioned"),
+            allowed_version_re=section["allowed_version_re"],
+            debian_branch=section["debian_branch"])
+
+
 def normalize_branch_name(branch_name):
     """Normalize branch name by removing debian- if exists"""
-    brnorm = branch_name
-    codename = get_distribution_codename()
-    if brnorm == "debian":
-        return "master"
-    elif brnorm == codename:
-        return "master"
-    elif brnorm == "debian-%s" % codename:
-        return "master"
-    elif brnorm.startswith("debian-%s-" % codename):
-        return brnorm.replace("debian-%s-" % codename, "", 1)
-    elif brnorm.startswith("debian-"):
-        return brnorm.replace("debian-", "", 1)
-    return brnorm
+    return classify_branch(branch_name).normalized
 
 
 def get_branch_type(branch_name):
     """Extract the type from a branch name"""
-    branch_name = normalize_branch_name(branch_name)
-    if "-" in branch_name:
-        btypestr = branch_name.split("-")[0]
-    else:
-        btypestr = branch_name
-    return btypestr
+    return classify_branch(branch_name).type
 
 
 def version_to_tag(version):
@@ -214,22 +526,22 @@ def version_to_tag(version):
 
 
 def undebianize(branch):
-    codename = get_distribution_codename()
-    if branch == "debian":
-        return "master"
-    elif branch == codename:
-        return "master"
-    elif branch == "debian-%s" % codename:
-        return "master"
-    elif branch.startswith("debian-%s-" % codename):
-        return branch.replace("debian-%s-" % codename, "", 1)
-    elif branch.startswith("debian-"):
-        return branch.replace("debian-", "")
-    else:
-        return branch
+    return classify_branch(branch).normalized
+
+
+_distribution_codename = None
 
 
 def get_distribution_codename():
+    # The codename is needed for every branch name that is normalized, so
+    # the commands are run only once
+    global _distribution_codename
+    if _distribution_codename is None:
+        _distribution_codename = _read_distribution_codename()
+    return _distribution_codename
+
+
+def _read_distribution_codename():
     codename = sh.uname().lower().strip()
     if codename == "linux":
         # lets try to be more specific using lsb_release
@@ -44,12 +44,16 @@ of the repository code.
 import os
 import re
 import sys
+import json
+import pipes
 import itertools
 
 from distutils import log  # pylint: disable=E0611
 
 from devflow import BRANCH_TYPES, BASE_VERSION_FILE, VERSION_RE
 from devflow import utils
+from devflow.cache import get_version_cache
+from devflow.refs import get_ref_index
 
 
 DEFAULT_VERSION_FILE = """
@@ -67,19 +71,51 @@ def get_base_version(vcs_info):
     """Determine the base version from a file in the repository"""
 
     f = open(os.path.join(vcs_info.toplevel, BASE_VERSION_FILE))
-    lines = [l.strip() for l in f.readlines()]
-    lines = [l for l in lines if not l.startswith("#")]
-    if len(lines) != 1:
-        raise ValueError("File '%s' should contain a single non-comment line.")
+    content = f.read()
     f.close()
+    return parse_base_version(content)
+
+
+def get_base_version_at(repo, rev):
+    """Determine the base version from the version file of a commit.
+
+    The file is read from the object database, without checking out 'rev'.
+    Base versions are kept in the shared version cache, if enabled.
+
+    """
+    cache = get_version_cache()
+    if cache is None:
+        content = utils.read_file_at(repo, rev, BASE_VERSION_FILE)
+        return parse_base_version(content)
+    sha = repo.commit(rev).hexsha
+    base_version = cache.get("base_version", sha, BASE_VERSION_FILE)
+    if base_version is None:
+        content = utils.read_file_at(repo, sha, BASE_VERSION_FILE)
+        base_version = parse_base_version(content)
+        cache.put("base_version", base_version, sha, BASE_VERSION_FILE)
+    return base_version
+
+
+def parse_base_version(content):
+    lines = [l.strip() for l in content.splitlines()]
+    lines = [l for l in lines if l and not l.startswith("#")]
+    if len(lines) != 1:
+        raise ValueError("File '%s' should contain a single non-comment line."
+                         % BASE_VERSION_FILE)
     return lines[0]
 
 
+_version_re = re.compile(VERSION_RE)
+
+
 def validate_version(base_version, vcs_info):
-    branch = vcs_info.branch
+    validate_branch_version(base_version, vcs_info.branch)
 
-    brnorm = utils.normalize_branch_name(branch)
-    btypestr = utils.get_branch_type(branch)
+
+def validate_branch_version(base_version, branch):
+    """Check that a base version is suitable for a branch"""
+    info = utils.classify_branch(branch)
+    btypestr = info.type
 
     try:
         btype = BRANCH_TYPES[btypestr]
@@ -89,19 +125,18 @@ def validate_version(base_version, vcs_info):
                          "of %s" % (btypestr, allowed_branches))
 
     if btype.versioned:
-        try:
-            bverstr = brnorm.split("-")[1]
-        except IndexError:
+        bverstr = info.version
+        if bverstr is None:
             # No version
             raise ValueError("Branch name '%s' should contain version" %
                              branch)
 
         # Check that version is well-formed
-        if not re.match(VERSION_RE, bverstr):
+        if not _version_re.match(bverstr):
             raise ValueError("Malformed version '%s' in branch name '%s'" %
                              (bverstr, branch))
 
-    m = re.match(btype.allowed_version_re, base_version)
+    m = utils.get_classifier().version_re(btypestr).match(base_version)
     if not m or (btype.versioned and m.groupdict()["bverstr"] != bverstr):
         raise ValueError("Base version '%s' unsuitable for branch name '%s'" %
                          (base_version, branch))
@@ -316,26 +351,221 @@ def debian_version_from_python_version(pyver):
     True
 
     """
-    version = pyver.replace("_", "~").replace("rc", "~rc")
     codename = utils.get_distribution_codename()
-    minor = str(get_revision(version, codename))
-    return version + "-" + minor + "~" + codename
+    return debian_versions_from_python_version(pyver, [codename])[0]
+
+
+def debian_versions_from_python_version(pyver, codenames):
+    """Generate the debian package versions of a Python version
+
+    Return one debian version for each of the given distribution codenames,
+    in the same order, allocating revisions from a single tag index scan.
+
+    """
+    version = Version.parse(pyver)
+    upstream = version.debian_upstream
+    from devflow.tags import get_tag_index
+    index = get_tag_index(utils.get_repository())
+    return [version.debian(index.next_debian_revision(upstream, codename),
+                           codename)
+            for codename in codenames]
+
+
+_debian_part_re = re.compile(r"([^0-9]*)([0-9]*)")
+# Sort keys of the non-digit strings of versions, which are few
+_lexical_orders = {}
+
+
+def _debian_part_key(part):
+    """Return a sort key for the upstream or revision part of a version.
+
+    The part is split in alternating non-digit and digit strings. Non-digit
+    strings are compared character by character, with '~' sorting before
+    everything (even the end of the string) and letters sorting before
+    non-letters. Digit strings are compared numerically. A trailing
+    non-digit element makes the end of the version compare after any '~'.
+
+    """
+    key = []
+    for lexical, digits in _debian_part_re.findall(part):
+        if not lexical and not digits:
+            continue
+        order = _lexical_orders.get(lexical)
+        if order is None:
+            order = tuple(-1 if c == "~" else ord(c) if c.isalpha()
+                          else ord(c) + 256 for c in lexical) + (0,)
+            _lexical_orders[lexical] = order
+        key.append(order)
+        key.append(int(digits or 0))
+    key.append((0,))
+    # A tuple, so that keys can be hashed
+    return tuple(key)
+
+
+def debian_version_key(version):
+    """Return a key that sorts Debian versions like dpkg does.
+
+    >>> versions = ["0.14next~150~abc1234-1~wheezy", "0.14-1~wheezy",
+    ...             "0.14~rc3-1~wheezy"]
+    >>> sorted(versions, key=debian_version_key)
+    ['0.14~rc3-1~wheezy', '0.14-1~wheezy', '0.14next~150~abc1234-1~wheezy']
+
+    """
+    epoch, _, rest = version.rpartition(":") if ":" in version\
+        else ("0", None, version)
+    upstream, _, revision = rest.rpartition("-") if "-" in rest\
+        else (rest, None, "")
+    return (int(epoch), _debian_part_key(upstream),
+            _debian_part_key(revision))
+
+
+_python_version_re = re.compile(
+    r"^(?P<numbers>[0-9]+(?:\.[0-9]+)*)(?:(?P<next>next)|rc(?P<rc>[0-9]+))?"
+    r"(?:_(?P<revno>[0-9]+)(?:_(?P<revid>[0-9a-f]+(?:_[0-9a-f]+)?))?)?$")
+
+
+class Version(object):
+    """A parsed python version, e.g. '0.14.1rc2_120_abc1234'.
+
+    The version is parsed once into its numeric components, its 'next' or
+    'rc' suffix and, for snapshots, its revision number and id. The
+    setuptools and Debian sort keys are computed on first use and cached.
+
+    >>> v = Version.parse("0.14rc2_120_abc1234")
+    >>> v.numbers, v.rc, v.revno, v.revid
+    ((0, 14), 2, 120, 'abc1234')
+    >>> v.base, v.debian_upstream
+    ('0.14rc2', '0.14~rc2~120~abc1234')
+    >>> v.debian_tag(1, "wheezy")
+    'debian/0.14rc2120abc1234-1wheezy'
+
+    """
+    __slots__ = ["numbers", "next", "rc", "revno", "revid", "_python",
+                 "_debian_key", "_setuptools_key"]
+
+    def __init__(self, numbers, next=False, rc=None, revno=None,
+                 revid=None):
+        self.numbers = tuple(numbers)
+        self.next = next
+        self.rc = rc
+        self.revno = revno
+        self.revid = revid
+        self._python = None
+        self._debian_key = None
+        self._setuptools_key = None
+
+    @classmethod
+    def parse(cls, version):
+        m = _python_version_re.match(version)
+        if m is None:
+            raise ValueError("Malformed version '%s'" % version)
+        rc, revno = m.group("rc"), m.group("revno")
+        parsed = cls(numbers=[int(n) for n in m.group("numbers").split(".")],
+                     next=m.group("next") is not None,
+                     rc=int(rc) if rc is not None else None,
+                     revno=int(revno) if revno is not None else None,
+                     revid=m.group("revid"))
+        parsed._python = version
+        return parsed
+
+    @property
+    def base(self):
+        """The base version, e.g. '0.14rc2'"""
+        base = ".".join(str(n) for n in self.numbers)
+        if self.next:
+            base += "next"
+        elif self.rc is not None:
+            base += "rc%d" % self.rc
+        return base
+
+    @property
+    def python(self):
+        if self._python is None:
+            v = self.base
+            if self.revno is not None:
+                v += "_%d" % self.revno
+                if self.revid is not None:
+                    v += "_" + self.revid
+            self._python = v
+        return self._python
+
+    @property
+    def debian_upstream(self):
+        """The upstream part of the debian version"""
+        return self.python.replace("_", "~").replace("rc", "~rc")
+
+    def debian(self, revision, codename):
+        return "%s-%s~%s" % (self.debian_upstream, revision, codename)
+
+    def debian_tag(self, revision, codename):
+        return "debian/" + utils.version_to_tag(self.debian(revision,
+                                                            codename))
+
+    @property
+    def debian_key(self):
+        if self._debian_key is None:
+            self._debian_key = debian_version_key(self.debian_upstream)
+        return self._debian_key
+
+    @property
+    def setuptools_key(self):
+        if self._setuptools_key is None:
+            from pkg_resources import parse_version
+            self._setuptools_key = parse_version(self.python)
+        return self._setuptools_key
+
+    def __str__(self):
+        return self.python
+
+    def __repr__(self):
+        return "<Version %s>" % self.python
+
+    def __hash__(self):
+        # Versions that are equal have the same debian key
+        return hash(self.debian_key)
+
+    def __eq__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.debian_key == other.debian_key
+
+    def __ne__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.debian_key != other.debian_key
+
+    def __lt__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.debian_key < other.debian_key
+
+    def __le__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.debian_key <= other.debian_key
+
+    def __gt__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.debian_key > other.debian_key
+
+    def __ge__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.debian_key >= other.debian_key
 
 
 def get_revision(version, codename):
     """Find revision for a debian version"""
-    version_tag = utils.version_to_tag(version)
-    repo = utils.get_repository()
-    minor = 1
-    while True:
-        tag = "debian/" + version_tag + "-" + str(minor) + codename
-        if tag in repo.tags:
-            minor += 1
-        else:
-            return minor
+    from devflow.tags import get_tag_index
+    index = get_tag_index(utils.get_repository())
+    return index.next_debian_revision(version, codename)
 
 
 def get_python_version():
+    env, _ = known_version_env()
+    if env is not None:
+        return env["DEVFLOW_VERSION"]
     v = utils.get_vcs_info()
     b = get_base_version(v)
     mode = utils.get_build_mode()
@@ -347,40 +577,46 @@ def debian_version(base_version, vcs_info, mode):
     return debian_version_from_python_version(p)
 
 
+def debian_versions(base_version, vcs_info, mode, codenames):
+    p = python_version(base_version, vcs_info, mode)
+    return debian_versions_from_python_version(p, codenames)
+
+
 def get_debian_version():
+    env, _ = known_version_env()
+    if env is not None:
+        return env["DEVFLOW_DEBIAN_VERSION"]
     v = utils.get_vcs_info()
     b = get_base_version(v)
     mode = utils.get_build_mode()
     return debian_version(b, v, mode)
 
 
-def update_version():
+def update_version(env=None):
     """Generate or replace version files
 
     Helper function for generating/replacing version files containing version
-    information.
+    information. The version information is taken from 'env', or from
+    known_version_env() without touching git, or is computed from the git
+    repository.
 
     """
 
-    v = utils.get_vcs_info()
-    toplevel = v.toplevel
-
-    config = utils.get_config()
-    if not v:
-        # Return early if not in development environment
-        raise RuntimeError("Can not compute version outside of a git"
-                           " repository.")
-    b = get_base_version(v)
-    mode = utils.get_build_mode()
-    version = python_version(b, v, mode)
-    debian_version_ = debian_version_from_python_version(version)
-    env = {"DEVFLOW_VERSION": version,
-           "DEVFLOW_DEBIAN_VERSION": debian_version_,
-           "DEVFLOW_BRANCH": v.branch,
-           "DEVFLOW_REVISION_ID": v.revid,
-           "DEVFLOW_REVISION_NUMBER": v.revno,
-           "DEVFLOW_USER_EMAIL": v.email,
-           "DEVFLOW_USER_NAME": v.name}
+    toplevel = None
+    if env is None:
+        env, toplevel = known_version_env()
+    if env is None:
+        v = utils.get_vcs_info()
+        if not v:
+            # Return early if not in development environment
+            raise RuntimeError("Can not compute version outside of a git"
+                               " repository.")
+        toplevel = v.toplevel
+        env = version_env(v)
+    elif toplevel is None:
+        toplevel = _find_toplevel()
+
+    config = utils.get_config(os.path.join(toplevel, "devflow.conf"))
 
     for _pkg_name, pkg_info in config['packages'].items():
         if pkg_info.get("version_file"):
@@ -422,6 +658,148 @@ def update_version():
                 f.write(content)
 
 
+def version_env(vcs_info, mode=None):
+    """Compute all version information of a commit
+
+    Returns a dict with the 'DEVFLOW_*' variables that are used in version
+    files.
+
+    """
+    base_version = get_base_version(vcs_info)
+    if mode is None:
+        mode = utils.get_build_mode()
+    version = python_version(base_version, vcs_info, mode)
+    return {"DEVFLOW_VERSION": version,
+            "DEVFLOW_DEBIAN_VERSION":
+            debian_version_from_python_version(version),
+            "DEVFLOW_BRANCH": vcs_info.branch,
+            "DEVFLOW_REVISION_ID": vcs_info.revid,
+            "DEVFLOW_REVISION_NUMBER": vcs_info.revno,
+            "DEVFLOW_USER_EMAIL": vcs_info.email,
+            "DEVFLOW_USER_NAME": vcs_info.name}
+
+
+# The variables of version_env(), that can be exported to child processes
+VERSION_ENV_KEYS = ["DEVFLOW_VERSION", "DEVFLOW_DEBIAN_VERSION",
+                    "DEVFLOW_BRANCH", "DEVFLOW_REVISION_ID",
+                    "DEVFLOW_REVISION_NUMBER", "DEVFLOW_USER_EMAIL",
+                    "DEVFLOW_USER_NAME"]
+
+
+def export_version_env(env, prefix="DEB_"):
+    """Export the output of version_env() to the environment
+
+    The variables are exported with 'prefix', 'DEB_' by default, so that they
+    are preserved by debuild.
+
+    """
+    for key in VERSION_ENV_KEYS:
+        os.environ[prefix + key] = str(env[key])
+
+
+def unexport_version_env():
+    """Remove any exported version_env() variables from the environment"""
+    for key in VERSION_ENV_KEYS:
+        for prefix in ["", "DEB_"]:
+            os.environ.pop(prefix + key, None)
+
+
+def exported_version_env(environ=None):
+    """Return the version_env() exported by a parent process, if any
+
+    A set of variables is used only if it is complete and consistent, looking
+    first for DEVFLOW_* and then for DEB_DEVFLOW_* variables. Returns None
+    if no such set is exported.
+
+    """
+    if environ is None:
+        environ = os.environ
+    for prefix in ["", "DEB_"]:
+        try:
+            env = dict((key, environ[prefix + key])
+                       for key in VERSION_ENV_KEYS)
+        except KeyError:
+            continue
+        try:
+            version = Version.parse(env["DEVFLOW_VERSION"])
+            env["DEVFLOW_REVISION_NUMBER"] = \
+                int(env["DEVFLOW_REVISION_NUMBER"])
+        except ValueError:
+            continue
+        if not env["DEVFLOW_DEBIAN_VERSION"].startswith(
+                version.debian_upstream + "-"):
+            continue
+        return env
+    return None
+
+
+def known_version_env():
+    """Return the version_env() that is known without running git
+
+    That is a set of variables exported by a parent process, or the version
+    state kept by the git hooks, if it is up to date. The debian version of
+    the state is computed from the tag index, as it changes with the debian
+    tags. Returns a tuple with the variables and the toplevel directory, if
+    known, or (None, None).
+
+    """
+    env = exported_version_env()
+    if env is not None:
+        return env, None
+    from devflow.state import read_state
+    state = read_state()
+    if state is not None:
+        env = dict(state["env"])
+        env["DEVFLOW_DEBIAN_VERSION"] = \
+            debian_version_from_python_version(env["DEVFLOW_VERSION"])
+        return env, state["toplevel"]
+    return None, None
+
+
+def _find_toplevel():
+    """Find the directory of devflow.conf, starting from the current one"""
+    path = os.getcwd()
+    while not os.path.exists(os.path.join(path, "devflow.conf")):
+        parent = os.path.dirname(path)
+        if parent == path:
+            raise RuntimeError("Can not find devflow.conf in '%s' or any"
+                               " parent directory." % os.getcwd())
+        path = parent
+    return path
+
+
+def all_versions(vcs_info):
+    """Return version_env() extended with the build information"""
+    mode = utils.get_build_mode()
+    env = version_env(vcs_info, mode)
+    env["DEVFLOW_BUILD_MODE"] = mode
+    env["DEVFLOW_CODENAME"] = utils.get_distribution_codename()
+    try:
+        debian_branch, _ = utils.find_debian_branch(
+            utils.undebianize(vcs_info.branch))
+    except (RuntimeError, ValueError):
+        debian_branch = ""
+    env["DEVFLOW_DEBIAN_BRANCH"] = debian_branch
+    return env
+
+
+def format_versions(env, fmt):
+    """Format the output of all_versions() as 'json' or 'shell'"""
+    if fmt == "json":
+        return json.dumps(env, indent=2, sort_keys=True,
+                          separators=(",", ": "))
+    elif fmt == "shell":
+        return "\n".join("%s=%s" % (key, pipes.quote(_shell_value(value)))
+                         for key, value in sorted(env.items()))
+    raise ValueError("Unknown format '%s'" % fmt)
+
+
+def _shell_value(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
 def bump_version_main():
     try:
         version = sys.argv[1]
@@ -431,55 +809,129 @@ def bump_version_main():
         sys.stdout.write("usage: %s version\n" % sys.argv[0])
 
 
-def _bump_version(new_version, v):
+def _bump_version(new_version, branch, transaction=None):
+    """Commit a new base version to a branch, without checking it out"""
     repo = utils.get_repository()
-    toplevel = repo.working_dir
-    old_version = get_base_version(v)
+    ref = "refs/heads/" + branch
+    if transaction is not None:
+        ref = transaction.resolve(ref)
+    content = utils.read_file_at(repo, ref, BASE_VERSION_FILE)
+    old_version = parse_base_version(content)
     sys.stdout.write("Current base version is '%s'\n" % old_version)
 
-    version_file = os.path.join(toplevel, "version")
-    sys.stdout.write("Updating version file %s from version '%s' to '%s'\n"
-                     % (version_file, old_version, new_version))
+    sys.stdout.write("Updating version file of branch %s from version '%s'"
+                     " to '%s'\n" % (branch, old_version, new_version))
 
-    f = open(version_file, 'rw+')
-    lines = f.readlines()
+    utils.commit_file(repo, branch, BASE_VERSION_FILE,
+                      replace_base_version(content, old_version, new_version),
+                      "Bump version to %s" % new_version, transaction)
+    sys.stdout.write("Update version file and commited\n")
+
+
+def replace_base_version(content, old_version, new_version):
+    """Return the contents of a version file with a new base version"""
+    lines = content.splitlines(True)
     for i in range(0, len(lines)):
         if not lines[i].startswith("#"):
             lines[i] = lines[i].replace(old_version, new_version)
-    f.seek(0)
-    f.truncate(0)
-    f.writelines(lines)
-    f.close()
+    return "".join(lines)
 
-    repo.git.add(version_file)
-    repo.git.commit(m="Bump version to %s" % new_version)
-    sys.stdout.write("Update version file and commited\n")
 
-
-def bump_version(new_version):
+def bump_version(new_version, branch=None, transaction=None):
     """Set new base version to base version file and commit"""
-    v = utils.get_vcs_info()
+    if branch is None:
+        branch = utils.get_repository().active_branch.name
 
     # Check that new base version is valid
-    validate_version(new_version, v)
-    _bump_version(new_version, v)
+    validate_branch_version(new_version, branch)
+    _bump_version(new_version, branch, transaction)
 
 
-def main():
-    v = utils.get_vcs_info()
-    b = get_base_version(v)
-    mode = utils.get_build_mode()
+def check_all_versions(repo=None):
+    """Validate the version file of every branch.
+
+    The version files are read from the tips of the branches through a
+    single 'git cat-file --batch' process, so no checkout is needed and
+    bare repositories are supported. Debian branches, which get their
+    version from the upstream branch they are built from, and branches that
+    are not of a known type are ignored. Prints a line per branch and
+    returns 1 if any version is invalid.
+
+    """
+    if repo is None:
+        repo = utils.get_repository()
+    index = get_ref_index(repo)
+    failed = False
+    for branch in sorted(index.branches):
+        info = utils.classify_branch(branch)
+        if info.debian or info.type not in BRANCH_TYPES:
+            continue
+        ref = "%s:%s" % (index.branches[branch], BASE_VERSION_FILE)
+        base_version = "-"
+        try:
+            try:
+                content = repo.git.get_object_data(ref)[3]
+            except ValueError:
+                raise ValueError("File '%s' does not exist" %
+                                 BASE_VERSION_FILE)
+            base_version = parse_base_version(content)
+            validate_branch_version(base_version, branch)
+            result = "OK"
+        except ValueError as e:
+            failed = True
+            result = "ERROR: %s" % e
+        print "%-40s %-16s %s" % (branch, base_version, result)
+    return 1 if failed else 0
 
+
+def main():
     try:
         arg = sys.argv[1]
-        assert arg == "python" or arg == "debian"
+        assert arg in ["python", "debian", "all", "check-all"]
     except IndexError:
-        raise ValueError("A single argument, 'python' or 'debian is required")
+        raise ValueError("A single argument, 'python', 'debian', 'all' or"
+                         " 'check-all' is required")
+
+    codenames = None
+    if arg == "debian" and len(sys.argv) > 2:
+        try:
+            assert sys.argv[2] == "--codenames"
+            codenames = [c for c in sys.argv[3].split(",") if c]
+            assert codenames
+        except (AssertionError, IndexError):
+            raise ValueError("usage: %s debian [--codenames a,b,c]"
+                             % sys.argv[0])
+
+    if arg == "check-all":
+        return check_all_versions()
+
+    fmt = "shell"
+    if arg == "all" and len(sys.argv) > 2:
+        try:
+            assert sys.argv[2] == "--format"
+            fmt = sys.argv[3]
+            assert fmt in ["json", "shell"]
+        except (AssertionError, IndexError):
+            raise ValueError("usage: %s all [--format json|shell]"
+                             % sys.argv[0])
 
     if arg == "python":
-        print python_version(b, v, mode)
-    elif arg == "debian":
-        print debian_version(b, v, mode)
+        print get_python_version()
+        return 0
+    elif arg == "debian" and not codenames:
+        print get_debian_version()
+        return 0
+
+    v = utils.get_vcs_info()
+    if arg == "all":
+        print format_versions(all_versions(v), fmt)
+        return 0
+
+    b = get_base_version(v)
+    mode = utils.get_build_mode()
+
+    for version in debian_versions(b, v, mode, codenames):
+        print version
 
 if __name__ == "__main__":
     sys.exit(main())
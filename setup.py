@@ -186,6 +186,9 @@ setup(
          'devflow-bump-version=devflow.versioning:bump_version_main',
          'devflow-update-version=devflow.versioning:update_version',
          'devflow-autopkg=devflow.autopkg:main',
+         'devflow-sign=devflow.signing:main',
+         'devflow-publish=devflow.publish:main',
+         'devflow-prune=devflow.prune:main',
          'devflow-flow=devflow.flow:main',
          ],
       },
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+#
+#
+
+"""Unit Tests for devflow.cache"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from devflow.cache import VersionCache
+
+
+class VersionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_put(self):
+        cache = VersionCache(self.directory)
+        self.assertEqual(cache.get("count", "a" * 40), None)
+        cache.put("count", 42, "a" * 40)
+        self.assertEqual(cache.get("count", "a" * 40), 42)
+        self.assertEqual(cache.get("count", "b" * 40), None)
+        self.assertEqual(cache.get("base_version", "a" * 40), None)
+        # Another cache on the same directory sees the entry
+        self.assertEqual(VersionCache(self.directory).get("count", "a" * 40),
+                         42)
+
+    def test_damaged_entry(self):
+        cache = VersionCache(self.directory)
+        cache.put("count", 42, "a" * 40)
+        path = cache._path(["count", "a" * 40])
+        with open(path, "w") as f:
+            f.write('{"key": ')
+        self.assertEqual(cache.get("count", "a" * 40), None)
+
+    def test_evict(self):
+        cache = VersionCache(self.directory, max_size=2)
+        for i, sha in enumerate("abc"):
+            cache.put("count", i, sha * 40)
+            path = cache._path(["count", sha * 40])
+            os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+        # Reading an entry makes it the most recently used
+        cache.get("count", "a" * 40)
+        cache.evict()
+        self.assertEqual(cache.get("count", "a" * 40), 0)
+        self.assertEqual(cache.get("count", "b" * 40), None)
+        self.assertEqual(cache.get("count", "c" * 40), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+#
+#
+
+"""Unit Tests for devflow.flow"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+from devflow.flow import GitManager
+
+
+class FindMergedBranchesTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.git("init", "-q", ".")
+        self.git("config", "user.name", "Test User")
+        self.git("config", "user.email", "test@example.com")
+        self.git("symbolic-ref", "HEAD", "refs/heads/master")
+        self.commit("version", "0.1\n")
+        self.git("checkout", "-q", "-b", "develop")
+        self.commit("version", "0.2next\n")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def git(self, *args):
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(("git",) + args, stdout=devnull)
+
+    def commit(self, path, content):
+        with open(path, "a") as f:
+            f.write(content)
+        self.git("add", path)
+        self.git("commit", "-q", "-m", "Update %s" % path)
+
+    def test_find_merged_branches(self):
+        # A merged feature, and a new feature without commits
+        self.git("checkout", "-q", "-b", "feature-done")
+        self.commit("done", "done\n")
+        self.git("checkout", "-q", "develop")
+        self.git("branch", "feature-new")
+        self.git("merge", "-q", "--no-ff", "-m", "Merge", "feature-done")
+        # A feature with commits that are not merged
+        self.git("checkout", "-q", "-b", "feature-open")
+        self.commit("open", "open\n")
+        self.git("checkout", "-q", "develop")
+        # develop moves ahead of the new feature
+        self.commit("file", "develop\n")
+        self.assertEqual(GitManager().find_merged_branches(),
+                         ["feature-done"])
+
+    def test_find_merged_debian_branches(self):
+        self.git("checkout", "-q", "-b", "debian-develop")
+        self.commit("debian", "debian\n")
+        self.git("checkout", "-q", "-b", "debian-develop-jessie")
+        self.commit("debian", "jessie\n")
+        self.git("checkout", "-q", "develop")
+        self.git("checkout", "-q", "-b", "feature-done")
+        self.commit("done", "done\n")
+        for suite in ["debian-develop", "debian-develop-jessie"]:
+            debian_branch = suite.replace("develop", "feature-done")
+            self.git("checkout", "-q", "-b", debian_branch, suite)
+            self.git("merge", "-q", "--no-ff", "-m", "Merge", "feature-done")
+            self.commit("debian", "feature\n")
+            self.git("checkout", "-q", suite)
+            self.git("merge", "-q", "--no-ff", "-m", "Merge", debian_branch)
+        self.git("checkout", "-q", "develop")
+        self.git("merge", "-q", "--no-ff", "-m", "Merge", "feature-done")
+        self.assertEqual(GitManager().find_merged_branches(),
+                         ["feature-done", "debian-feature-done",
+                          "debian-feature-done-jessie"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+#
+#
+
+"""Unit Tests for devflow.publish"""
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+import subprocess
+from devflow.publish import AptRepository, parse_control
+
+
+class PublishTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.build_dir = os.path.join(self.directory, "build")
+        self.root = os.path.join(self.directory, "repo")
+        os.makedirs(self.build_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build_deb(self, package, version, arch):
+        tree = os.path.join(self.directory, "%s_%s" % (package, arch))
+        os.makedirs(os.path.join(tree, "DEBIAN"))
+        with open(os.path.join(tree, "DEBIAN", "control"), "w") as f:
+            f.write("Package: %s\nVersion: %s\nArchitecture: %s\n"
+                    "Maintainer: Test User <test@example.com>\n"
+                    "Description: test package\n" % (package, version, arch))
+        name = "%s_%s_%s.deb" % (package, version, arch)
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(["dpkg-deb", "-Zgzip", "--build", tree,
+                                   os.path.join(self.build_dir, name)],
+                                  stdout=devnull)
+        shutil.rmtree(tree)
+        return name
+
+    def build_upload(self, source, version, dist, binaries):
+        """Create the files of an upload and return its .changes file."""
+        tarball = "%s_%s.tar.gz" % (source, version)
+        with open(os.path.join(self.build_dir, tarball), "w") as f:
+            f.write("tarball")
+        dsc = "%s_%s.dsc" % (source, version)
+        with open(os.path.join(self.build_dir, dsc), "w") as f:
+            f.write("Format: 3.0 (native)\nSource: %s\nVersion: %s\n"
+                    "Files:\n d41d8cd98f00b204e9800998ecf8427e 7 %s\n"
+                    % (source, version, tarball))
+        names = [dsc, tarball]
+        for package, arch in binaries:
+            names.append(self.build_deb(package, version, arch))
+        changes = os.path.join(self.build_dir, "%s_%s_%s.changes"
+                               % (source, version, dist))
+        with open(changes, "w") as f:
+            f.write("Format: 1.8\nSource: %s\nDistribution: %s\n"
+                    "Version: %s\nFiles:\n" % (source, dist, version))
+            for name in names:
+                f.write(" 0 0 misc optional %s\n" % name)
+        return changes
+
+    def publish(self, changes, architectures=("amd64",)):
+        repo = AptRepository(self.root, architectures=list(architectures))
+        try:
+            published = repo.publish_changes(changes)
+            repo.write_indices()
+        finally:
+            repo.close()
+        return published
+
+    def read_index(self, dist, *path):
+        path = os.path.join(self.root, "dists", dist, "main", *path)
+        with open(path) as f:
+            data = f.read()
+        with gzip.open(path + ".gz") as f:
+            self.assertEqual(f.read(), data)
+        return [parse_control(stanza) for stanza in data.split("\n\n")
+                if stanza.strip()]
+
+    def packages(self, dist, arch):
+        return sorted((c["Package"], c["Version"])
+                      for c in self.read_index(dist, "binary-" + arch,
+                                               "Packages"))
+
+    def sources(self, dist):
+        return sorted((c["Package"], c["Version"])
+                      for c in self.read_index(dist, "source", "Sources"))
+
+
+class IndexTest(PublishTestCase):
+    def test_publish(self):
+        changes = self.build_upload("foo", "1.0", "unstable",
+                                    [("foo", "amd64"), ("foo-doc", "all")])
+        self.assertEqual(self.publish(changes), 3)
+        self.assertEqual(self.packages("unstable", "amd64"),
+                         [("foo", "1.0"), ("foo-doc", "1.0")])
+        self.assertEqual(self.sources("unstable"), [("foo", "1.0")])
+        stanza = self.read_index("unstable", "binary-amd64", "Packages")[0]
+        self.assertTrue(os.path.exists(os.path.join(self.root,
+                                                    stanza["Filename"])))
+        self.assertEqual(int(stanza["Size"]),
+                         os.path.getsize(os.path.join(self.root,
+                                                      stanza["Filename"])))
+
+    def test_republish(self):
+        changes = self.build_upload("foo", "1.0", "unstable",
+                                    [("foo", "amd64")])
+        self.publish(changes)
+        self.assertEqual(self.publish(changes), 0)
+        self.assertEqual(self.packages("unstable", "amd64"), [("foo", "1.0")])
+        self.assertEqual(self.sources("unstable"), [("foo", "1.0")])
+
+    def test_new_architecture(self):
+        self.publish(self.build_upload("foo", "1.0", "unstable",
+                                       [("foo", "amd64"),
+                                        ("foo-doc", "all")]))
+        self.publish(self.build_upload("bar", "1.0", "unstable",
+                                       [("bar", "i386")]),
+                     architectures=["i386"])
+        # Architecture independent packages are indexed for every
+        # architecture
+        self.assertEqual(self.packages("unstable", "i386"),
+                         [("bar", "1.0"), ("foo-doc", "1.0")])
+        self.assertEqual(self.packages("unstable", "amd64"),
+                         [("foo", "1.0"), ("foo-doc", "1.0")])
+        self.assertEqual(self.sources("unstable"),
+                         [("bar", "1.0"), ("foo", "1.0")])
+
+    def test_release(self):
+        self.publish(self.build_upload("foo", "1.0", "unstable",
+                                       [("foo", "amd64")]))
+        with open(os.path.join(self.root, "dists", "unstable",
+                               "Release")) as f:
+            release = parse_control(f.read())
+        self.assertEqual(release["Architectures"], "amd64")
+        listed = [line.split()[-1]
+                  for line in release["SHA256"].splitlines() if line.strip()]
+        self.assertEqual(sorted(listed),
+                         ["main/binary-amd64/Packages",
+                          "main/binary-amd64/Packages.gz",
+                          "main/source/Sources",
+                          "main/source/Sources.gz"])
+
+    def test_recover(self):
+        self.publish(self.build_upload("foo", "1.0", "unstable",
+                                       [("foo", "amd64")]))
+        index = os.path.join(self.root, "dists", "unstable", "main",
+                             "binary-amd64", "Packages")
+        # An interrupted run leaves its journal and partial indices behind
+        with open(index, "w") as f:
+            f.write("Package: partial\n")
+        with open(os.path.join(self.root, "db", "dirty-main"), "w") as f:
+            f.write("unstable\n")
+        AptRepository(self.root).close()
+        self.assertEqual(self.packages("unstable", "amd64"), [("foo", "1.0")])
+        self.assertFalse(os.path.exists(os.path.join(self.root, "db",
+                                                     "dirty-main")))
+
+
+class RemoveFilesTest(PublishTestCase):
+    def setUp(self):
+        super(RemoveFilesTest, self).setUp()
+        for version in ("1.0", "1.1"):
+            self.publish(self.build_upload("foo", version, "unstable",
+                                           [("foo", "amd64"),
+                                            ("foo-doc", "all")]))
+
+    def remove(self, *names):
+        repo = AptRepository(self.root)
+        try:
+            return repo.remove_files(os.path.join("pool", "main", "f",
+                                                  "foo", name)
+                                     for name in names)
+        finally:
+            repo.close()
+
+    def test_remove_binaries(self):
+        dists = self.remove("foo_1.0_amd64.deb", "foo-doc_1.0_all.deb")
+        self.assertEqual(dists, set(["unstable"]))
+        self.assertEqual(self.packages("unstable", "amd64"),
+                         [("foo", "1.1"), ("foo-doc", "1.1")])
+        self.assertEqual(self.sources("unstable"),
+                         [("foo", "1.0"), ("foo", "1.1")])
+
+    def test_remove_source(self):
+        dists = self.remove("foo_1.0.tar.gz")
+        self.assertEqual(dists, set(["unstable"]))
+        self.assertEqual(self.sources("unstable"), [("foo", "1.1")])
+        self.assertEqual(len(self.packages("unstable", "amd64")), 4)
+
+    def test_unknown_files(self):
+        self.assertEqual(self.remove("bar_1.0_amd64.deb"), set())
+        self.assertEqual(len(self.packages("unstable", "amd64")), 4)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "db",
+                                                     "dirty-main")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+#
+#
+
+"""Unit Tests for devflow.refs"""
+
+import os
+import git
+import shutil
+import tempfile
+import unittest
+import subprocess
+from devflow.refs import RefTransaction
+
+
+class RefTransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.git("init", "-q", ".")
+        self.git("config", "user.name", "Test User")
+        self.git("config", "user.email", "test@example.com")
+        self.git("symbolic-ref", "HEAD", "refs/heads/master")
+        self.first = self.commit("version", "0.1\n")
+        self.git("branch", "develop")
+        self.second = self.commit("version", "0.2\n")
+        self.repo = git.Repo(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def git(self, *args):
+        return subprocess.check_output(("git",) + args,
+                                       cwd=self.directory).strip()
+
+    def commit(self, path, content):
+        with open(os.path.join(self.directory, path), "w") as f:
+            f.write(content)
+        self.git("add", path)
+        self.git("commit", "-q", "-m", "Update %s" % path)
+        return self.git("rev-parse", "HEAD")
+
+    def refs(self):
+        output = self.git("for-each-ref", "--format=%(refname) %(objectname)")
+        return dict(line.split() for line in output.splitlines())
+
+    def read_version(self):
+        with open(os.path.join(self.directory, "version")) as f:
+            return f.read()
+
+    def test_rollback(self):
+        original = self.refs()
+        transaction = RefTransaction(self.repo)
+        transaction.update("refs/heads/develop", self.second)
+        transaction.update("refs/heads/feature-a", self.first)
+        transaction.delete("refs/heads/master")
+        transaction.commit(checkout="develop")
+        self.assertEqual(self.refs(), {"refs/heads/develop": self.second,
+                                       "refs/heads/feature-a": self.first})
+        transaction.rollback()
+        self.assertEqual(self.refs(), original)
+        self.assertEqual(self.git("symbolic-ref", "HEAD"),
+                         "refs/heads/develop")
+
+    def test_rollback_pending(self):
+        original = self.refs()
+        transaction = RefTransaction(self.repo)
+        transaction.update("refs/heads/develop", self.second)
+        transaction.rollback()
+        self.assertEqual(self.refs(), original)
+        transaction.commit()
+        self.assertEqual(self.refs(), original)
+
+    def test_rollback_keeps_worktree(self):
+        transaction = RefTransaction(self.repo)
+        transaction.update("refs/heads/master", self.first)
+        transaction.commit()
+        self.assertEqual(self.read_version(), "0.1\n")
+        transaction.rollback()
+        self.assertEqual(self.refs()["refs/heads/master"], self.second)
+        # The worktree is left for the caller to restore
+        self.assertEqual(self.read_version(), "0.1\n")
+
+    def test_reload(self):
+        transaction = RefTransaction(self.repo)
+        transaction.update("refs/heads/develop", self.second)
+        transaction.commit()
+        # The user moves the branch, e.g. while resolving conflicts
+        self.git("update-ref", "refs/heads/develop", self.first)
+        transaction.reload("refs/heads/develop")
+        transaction.rollback()
+        self.assertEqual(self.refs()["refs/heads/develop"], self.first)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, 2013 GRNET S.A. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+#   1. Redistributions of source code must retain the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY GRNET S.A. ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL GRNET S.A OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+# USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of GRNET S.A.
+#
+#
+
+"""Unit Tests for devflow.state"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+from devflow import state
+# Imported lazily by devflow.state, before the tests change the working
+# directory
+import devflow.versioning
+import devflow.tags
+
+
+class ReadStateTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.mode = os.environ.pop("DEVFLOW_BUILD_MODE", None)
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.git("init", "-q", ".")
+        self.git("symbolic-ref", "HEAD", "refs/heads/develop")
+        self.git("config", "user.name", "Test User")
+        self.git("config", "user.email", "test@example.com")
+        self.commit("version", "0.2next\n")
+        self.assertNotEqual(state.update_state(), None)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+        if self.mode is not None:
+            os.environ["DEVFLOW_BUILD_MODE"] = self.mode
+        else:
+            os.environ.pop("DEVFLOW_BUILD_MODE", None)
+
+    def git(self, *args):
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(("git",) + args, stdout=devnull)
+
+    def commit(self, path, content):
+        with open(path, "w") as f:
+            f.write(content)
+        self.git("add", path)
+        self.git("commit", "-q", "-m", "Update %s" % path)
+
+    def test_up_to_date(self):
+        s = state.read_state()
+        self.assertEqual(s["branch"], "develop")
+        self.assertEqual(s["ref"], "refs/heads/develop")
+        self.assertTrue(s["env"]["DEVFLOW_VERSION"].startswith("0.2next_1_"))
+        # The debian version depends on tags, and is not kept
+        self.assertFalse("DEVFLOW_DEBIAN_VERSION" in s["env"])
+
+    def test_new_commit(self):
+        self.commit("file", "new\n")
+        self.assertEqual(state.read_state(), None)
+        self.assertNotEqual(state.update_state(), None)
+        self.assertNotEqual(state.read_state(), None)
+
+    def test_renamed_branch(self):
+        self.git("branch", "-m", "develop", "release-0.9")
+        self.assertEqual(state.read_state(), None)
+
+    def test_packed_refs(self):
+        self.git("pack-refs", "--all")
+        self.assertNotEqual(state.read_state(), None)
+
+    def test_version_file(self):
+        with open("version", "w") as f:
+            f.write("0.3next\n")
+        self.assertEqual(state.read_state(), None)
+
+    def test_build_mode(self):
+        os.environ["DEVFLOW_BUILD_MODE"] = "snapshot"
+        self.assertNotEqual(state.read_state(), None)
+        os.environ["DEVFLOW_BUILD_MODE"] = "release"
+        self.assertEqual(state.read_state(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -45,7 +45,8 @@ for automatic generation of version strings.
 import os
 import unittest
 from pkg_resources import parse_version
-from devflow.versioning import debian_version_from_python_version
+from devflow.versioning import debian_version_from_python_version,\
+    debian_version_key, Version
 
 
 class DebianVersionObject(object):
@@ -123,6 +124,39 @@ class TestVersionFunctions(unittest.TestCase):
             self.assertTrue(res, "Debian version %s %s %s"
                                  " is not True" % (a, op, b))
 
+    def test_debian_version_key(self):
+        def K(v):
+            debver = v.replace("_", "~").replace("rc", "~rc") + "-1~wheezy"
+            return debian_version_key(debver)
+        for a, op, b in self.version_orderings:
+            res = compare(K, a, op, b)
+            self.assertTrue(res, "Debian version key %s %s %s"
+                                 " is not True" % (a, op, b))
+        self.assertTrue(debian_version_key("1:0.1") >
+                        debian_version_key("2.0"))
+        self.assertTrue(debian_version_key("1.0~rc1-1") <
+                        debian_version_key("1.0-1"))
+        self.assertEqual(debian_version_key("1.0-1"),
+                         debian_version_key("1.00-1"))
+
+    def test_version_objects(self):
+        for a, op, b in self.version_orderings:
+            self.assertEqual(Version.parse(a).python, a)
+            res = compare(Version.parse, a, op, b)
+            self.assertTrue(res, "Version object %s %s %s"
+                                 " is not True" % (a, op, b))
+        versions = [Version.parse(v) for v in ["0.14", "0.14rc3_120",
+                                               "0.13next", "0.14.1_149"]]
+        self.assertEqual([str(v) for v in sorted(versions)],
+                         ["0.13next", "0.14rc3_120", "0.14", "0.14.1_149"])
+        self.assertRaises(ValueError, Version.parse, "0.14foo")
+        # Equal versions are interchangeable in sets and dicts
+        self.assertEqual(Version.parse("1.0"), Version.parse("1.00"))
+        self.assertEqual(len(set([Version.parse("1.0"),
+                                  Version.parse("1.00")])), 1)
+        self.assertFalse(Version.parse("1.0") == "1.0")
+        self.assertTrue(Version.parse("1.0") != "1.0")
+
 
 def compare(function, a, op, b):
     import operator